@@ -3,15 +3,25 @@
 # Features:
 # - /start grants 80k once per account (requires 8 wager rounds to free-to-withdraw)
 # - Admin approve groups; /batdau requests approval
-# - Bets: /T<amount> for Tài, /X<amount> for Xỉu (in group when running & approved)
+# - Bets: /T<amount> or T<amount> for Tài, X for Xỉu; "X 5k", "T1tr", "T all" (in group when running & approved)
 # - Auto cycle 60s; countdown 30s/10s/5s; lock chat at 5s; send GIF spin then 3 dice sequentially
 # - Random rule: time (HHMM as number) + last4(round_epoch) parity -> odd = Tài, even = Xỉu
 # - Promo code creation / redeem; promo requires N rounds wagering
-# - Pot ("hũ") mechanics (house share goes to pot; triple1/6 distributes pot proportionally)
-# - Admin commands: /addmoney, /top10, /balances, /code, /nhancode, /KqTai /KqXiu /bettai /betxiu /tatbet
-# - Private menu (Game, Nạp, Rút, Số dư)
-# - Database SQLite (tx_bot_data.db by default)
+# - Pot ("hũ") mechanics (house share goes to pot; triple1/6 distributes pot proportionally);
+#   per-group pot shards, one delta per settled round
+# - Admin commands: /addmoney, /top10, /balances, /users, /ledger, /export, /backup, /thongke, /code, /nhancode, /KqTai /KqXiu /bettai /betxiu /tatbet
+# - Admin diagnostics: /profile <seconds> (sampling profiler of the event loop thread), /lag (loop lag watchdog),
+#   /mem (RSS, live asyncio tasks, tracemalloc growth)
+# - Keep-alive port serves /metrics (Prometheus text)
+# - Private menu (Game, Nạp, Rút, Số dư); /lichsu shows the user's settled bets (monthly archive partitions)
+# - Database SQLite (tx_bot_data.db by default); balances are an append-only ledger + snapshots
 # - Uses python-telegram-bot v20+ style async Application
+# - Opt-in anonymised update recorder (RECORD_UPDATES_FILE) + `python bot.py replay <file> --speed N`
+# - History older than HISTORY_RETENTION_DAYS is rolled up daily and moved to gzip JSONL files
+# - Scheduled online backups (SQLite backup API, gzip, rotation) into BACKUP_DIR
+# - Streaming gzip CSV/JSONL export: /export (admin) or `python bot.py export <table>`
+# - Dice drawn from the OS CSPRNG (buffered, rejection-sampled); `python bot.py dicetest` self-test
+# - Offline Monte Carlo of the settlement rules: `python bot.py simulate`
 
 import os
 import sys
@@ -19,13 +29,36 @@ import sqlite3
 import random
 import traceback
 import logging
+import logging.handlers
+import contextvars
+import copy
+import atexit
 import threading
 import http.server
 import socketserver
 import asyncio
-from datetime import datetime
+import re
+import json
+import gzip
+import hmac
+import hashlib
+import time
+import queue
+import argparse
+import unicodedata
+import io
+import collections
+import functools
+import csv
+import shutil
+import tempfile
+import tracemalloc
+from decimal import Decimal
+from datetime import datetime, timezone
 from typing import List, Tuple, Optional, Dict, Any
 import secrets
+import numpy as np
+from contextlib import contextmanager, asynccontextmanager
 
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup,
@@ -33,23 +66,52 @@ from telegram import (
 )
 from telegram.ext import (
     ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler,
-    filters, Application
+    filters, Application, TypeHandler, ChatMemberHandler
 )
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest
 
 # -----------------------
 # Keep port open (for Render)
 # -----------------------
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # /metrics needs "Authorization: Bearer <token>"; unset = disabled
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    """Health check for Render plus Prometheus-style /metrics (no files from the cwd are served).
+    PORT is public, so /metrics is only served to callers holding METRICS_TOKEN."""
+
+    def _metrics_allowed(self) -> bool:
+        auth = self.headers.get("Authorization") or ""
+        return bool(METRICS_TOKEN) and hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode())
+
+    def do_GET(self):
+        status = 200
+        ctype = "text/plain"
+        if not self.path.startswith("/metrics"):
+            body = b"OK"
+        elif self._metrics_allowed():
+            body = render_metrics().encode()
+            ctype = "text/plain; version=0.0.4"
+        else:
+            status, body = 404, b"Not Found"
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # health probes would flood the log
+
 def keep_port_open():
     PORT = int(os.getenv("PORT", "10000"))
-    handler = http.server.SimpleHTTPRequestHandler
+    handler = KeepAliveHandler
     try:
         with socketserver.TCPServer(("", PORT), handler) as httpd:
-            print(f"[keep_port_open] serving on port {PORT}")
+            logger.info(f"[keep_port_open] serving on port {PORT}")
             httpd.serve_forever()
     except Exception as e:
-        print(f"[keep_port_open] {e}")
-
-threading.Thread(target=keep_port_open, daemon=True).start()
+        logger.warning(f"[keep_port_open] {e}")
 
 # -----------------------
 # Configuration
@@ -64,11 +126,128 @@ WIN_MULTIPLIER = float(os.getenv("WIN_MULTIPLIER", "1.97"))
 HOUSE_RATE = float(os.getenv("HOUSE_RATE", "0.03"))
 DB_FILE = os.getenv("DB_FILE", "tx_bot_data.db")
 MAX_HISTORY = int(os.getenv("MAX_HISTORY", "20"))
+WITHDRAW_MIN = int(os.getenv("WITHDRAW_MIN", "100000"))
+WITHDRAW_DAILY_LIMIT = int(os.getenv("WITHDRAW_DAILY_LIMIT", "1000000"))
+# users columns ranked via a descending index; "balance" ranks from balance_snapshots (get_balance_leaderboard)
+LEADERBOARD_COLUMNS = ("total_deposited", "total_bet_volume", "best_streak")
 # GIF for 3D dice spin (your provided link)
 DICE_SPIN_GIF_URL = os.getenv("DICE_SPIN_GIF_URL", "https://www.emojiall.com/images/60/telegram/1f3b2.gif")
-
-# logging
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+# Update recorder (opt-in): append anonymised incoming updates to this file (.gz = gzip)
+RECORD_UPDATES_FILE = os.getenv("RECORD_UPDATES_FILE", "")
+RECORD_SALT = os.getenv("RECORD_SALT", "")  # secret used to pseudonymise ids/names in recordings (required)
+
+# logging: records are queued on the calling thread and written by a listener thread,
+# so a burst of errors never blocks the event loop on stderr I/O or traceback formatting
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_RATE_PER_SITE = float(os.getenv("LOG_RATE_PER_SITE", "5"))  # records/s allowed from one logging call site
+LOG_BURST_PER_SITE = int(os.getenv("LOG_BURST_PER_SITE", "20"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "httpx=0.01")  # logger=rate,... keeps only a sample of chatty loggers
+
+log_chat_id: contextvars.ContextVar = contextvars.ContextVar("log_chat_id", default=None)
+log_round_id: contextvars.ContextVar = contextvars.ContextVar("log_round_id", default=None)
+log_user_id: contextvars.ContextVar = contextvars.ContextVar("log_user_id", default=None)
+
+def set_log_context(chat_id: Optional[int] = None, round_id: Optional[str] = None, user_id: Optional[int] = None):
+    """Ids attached to every log record emitted from the current task."""
+    log_chat_id.set(chat_id)
+    log_round_id.set(round_id)
+    log_user_id.set(user_id)
+
+class LogContextFilter(logging.Filter):
+    """Samples chatty loggers, rate-limits each call site (token bucket) and stamps context ids."""
+
+    def __init__(self, sample_rates: Dict[str, float], rate: float, burst: int):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.rate = rate
+        self.burst = burst
+        self._rate_for_logger: Dict[str, float] = {}
+        self._buckets: Dict[Tuple[str, int], List[float]] = {}  # site -> [tokens, last, suppressed]
+        self._lock = threading.Lock()
+
+    def _sample_rate(self, name: str) -> float:
+        rate = self._rate_for_logger.get(name)
+        if rate is None:
+            rate = 1.0
+            for prefix, r in self.sample_rates.items():
+                if name == prefix or name.startswith(prefix + "."):
+                    rate = r
+            self._rate_for_logger[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self._sample_rate(record.name)
+        if rate < 1.0 and random.random() >= rate:
+            return False
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(site)
+            if bucket is None:
+                bucket = self._buckets[site] = [float(self.burst), now, 0]
+            bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            record.suppressed = int(bucket[2])
+            bucket[2] = 0
+        for attr, var in (("chat_id", log_chat_id), ("round_id", log_round_id), ("user_id", log_user_id)):
+            if getattr(record, attr, None) is None:
+                setattr(record, attr, var.get())
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for attr in ("chat_id", "round_id", "user_id", "suppressed"):
+            value = getattr(record, attr, None)
+            if value:
+                data[attr] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data["stack"] = record.stack_info
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Only merges msg % args on the caller's thread; tracebacks are formatted by the listener."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging() -> logging.handlers.QueueListener:
+    stream = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream.setFormatter(JsonLogFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    sample_rates = {}
+    for item in LOG_SAMPLE_RATES.split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            sample_rates[name.strip()] = float(rate)
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter(sample_rates, LOG_RATE_PER_SITE, LOG_BURST_PER_SITE))
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(logging.INFO)
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # -----------------------
@@ -79,6 +258,12 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
+def ensure_column(cur, table: str, column: str, decl: str):
+    """Idempotent ALTER TABLE ADD COLUMN for databases created by older versions."""
+    cols = {r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column not in cols:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
 def init_db():
     conn = get_db_connection()
     cur = conn.cursor()
@@ -132,6 +317,102 @@ def init_db():
     );
     """)
     cur.execute("INSERT OR IGNORE INTO pot(id, amount) VALUES (1, 0)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS pot_shards (
+        chat_id INTEGER PRIMARY KEY, -- 0 = legacy/global shard
+        amount INTEGER DEFAULT 0     -- minor units
+    )
+    """)
+    # move the single-row pot from older versions into shard 0 (once: the row is zeroed)
+    legacy = cur.execute("SELECT amount FROM pot WHERE id=1").fetchone()[0] or 0
+    if legacy:
+        cur.execute(
+            "INSERT INTO pot_shards(chat_id, amount) VALUES (0, ?) ON CONFLICT(chat_id) DO UPDATE SET amount = amount + excluded.amount",
+            (to_minor(legacy),)
+        )
+        cur.execute("UPDATE pot SET amount=0 WHERE id=1")
+    # leaderboard indexes: SQLite keeps them sorted as deposits/settlement write,
+    # so a top-N read walks N index entries instead of sorting the users table
+    for column in LEADERBOARD_COLUMNS:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_users_{column} ON users({column} DESC)")
+    # normalised username (search_name) and first_name (search_first) for the admin user
+    # browser's prefix search; one index each, merged by fetch_user_page
+    ensure_column(cur, "users", "search_name", "TEXT")
+    ensure_column(cur, "users", "search_first", "TEXT")
+    missing = cur.execute("SELECT user_id, username, first_name FROM users WHERE search_name IS NULL OR search_first IS NULL").fetchall()
+    if missing:
+        cur.executemany(
+            "UPDATE users SET search_name=?, search_first=? WHERE user_id=?",
+            [(*user_search_names(r["username"], r["first_name"]), r["user_id"]) for r in missing]
+        )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_search ON users(search_name, user_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_search_first ON users(search_first, user_id)")
+    # one position per (chat, round, user, side): repeated /T /X are upserted into it (place_bet);
+    # merge rows written by older versions before the unique index goes on
+    ensure_column(cur, "bets", "bet_count", "INTEGER DEFAULT 1")
+    dup_positions = cur.execute(
+        "SELECT MIN(id), SUM(amount), SUM(COALESCE(bet_count, 1)), chat_id, round_id, user_id, side FROM bets "
+        "GROUP BY chat_id, round_id, user_id, side HAVING COUNT(*) > 1"
+    ).fetchall()
+    for keep_id, amount, count, chat_id, round_id, user_id, side in dup_positions:
+        cur.execute("UPDATE bets SET amount=?, bet_count=? WHERE id=?", (amount, count, keep_id))
+        cur.execute(
+            "DELETE FROM bets WHERE chat_id=? AND round_id=? AND user_id=? AND side=? AND id != ?",
+            (chat_id, round_id, user_id, side, keep_id)
+        )
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_bets_position ON bets(chat_id, round_id, user_id, side)")
+    # history: per-group recent lookups + retention rollups (see rollup_and_archive_history)
+    ensure_column(cur, "history", "volume", "REAL DEFAULT 0")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_history_chat ON history(chat_id, id)")
+    # settled=0: result rolled but payouts not committed yet (settle_round / settle_pending_rounds);
+    # rows written before the column existed were settled inline
+    ensure_column(cur, "history", "settled", "INTEGER DEFAULT 1")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_history_unsettled ON history(round_index) WHERE settled=0")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS history_daily (
+        chat_id INTEGER,
+        day TEXT,
+        rounds INTEGER DEFAULT 0,
+        tai INTEGER DEFAULT 0,
+        xiu INTEGER DEFAULT 0,
+        triples INTEGER DEFAULT 0,
+        volume REAL DEFAULT 0,
+        PRIMARY KEY (chat_id, day)
+    ) WITHOUT ROWID
+    """)
+    # append-only balance ledger (amounts in minor units, see MONEY_SCALE)
+    cur.executescript("""
+    CREATE TABLE IF NOT EXISTS ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL, -- bet / payout / bonus / promo / deposit / withdrawal / pot / adjust / opening
+        amount INTEGER NOT NULL,
+        ref TEXT,
+        created_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger(user_id, id, amount);
+    CREATE TABLE IF NOT EXISTS balance_snapshots (
+        user_id INTEGER PRIMARY KEY,
+        balance INTEGER NOT NULL,
+        last_entry_id INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS ledger_meta (
+        id INTEGER PRIMARY KEY CHECK (id=1),
+        snapshot_id INTEGER DEFAULT 0,
+        migrated INTEGER DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_balance_snapshots_balance ON balance_snapshots(balance DESC, user_id);
+    """)
+    cur.execute("INSERT OR IGNORE INTO ledger_meta(id, snapshot_id, migrated) VALUES (1, 0, 0)")
+    if cur.execute("SELECT migrated FROM ledger_meta WHERE id=1").fetchone()[0] == 0:
+        # one-off: carry REAL balances from older versions over as opening entries
+        cur.execute(
+            "INSERT INTO ledger(user_id, kind, amount, ref, created_at) "
+            "SELECT user_id, 'opening', CAST(ROUND(balance * ?) AS INTEGER), 'migration', ? FROM users WHERE COALESCE(balance, 0) != 0",
+            (MONEY_SCALE, now_iso())
+        )
+        cur.execute("UPDATE ledger_meta SET migrated=1 WHERE id=1")
+    snapshot_balances(cur)
     # promo tables
     cur.executescript("""
     CREATE TABLE IF NOT EXISTS promo_codes (
@@ -154,6 +435,32 @@ def init_db():
         redeemed_at TEXT
     );
     """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_promo_redemptions_user ON promo_redemptions(user_id, active)")
+    # withdrawals: requests + per-user daily running total (limit check is a PK lookup)
+    cur.executescript("""
+    CREATE TABLE IF NOT EXISTS withdrawals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount REAL,
+        bank TEXT,
+        account TEXT,
+        status TEXT DEFAULT 'pending', -- pending / approved / rejected
+        created_at TEXT,
+        decided_at TEXT,
+        decided_by INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawals(user_id, id);
+    CREATE TABLE IF NOT EXISTS withdrawal_daily (
+        user_id INTEGER,
+        day TEXT,
+        total REAL DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID;
+    """)
+    # databases where `withdrawals` was created by hand only had (user_id, amount, created_at)
+    for column, decl in (("bank", "TEXT"), ("account", "TEXT"), ("status", "TEXT DEFAULT 'approved'"),
+                         ("decided_at", "TEXT"), ("decided_by", "INTEGER")):
+        ensure_column(cur, "withdrawals", column, decl)
     conn.commit()
     conn.close()
 
@@ -166,6 +473,27 @@ def db_execute(query: str, params: Tuple = ()):
     conn.close()
     return lastrowid
 
+@contextmanager
+def db_transaction():
+    """BEGIN IMMEDIATE ... COMMIT on one connection; rolls back if the block raises."""
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def db_executemany(query: str, seq_params: List[Tuple]):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.executemany(query, seq_params)
+    conn.commit()
+    conn.close()
+
 def db_query(query: str, params: Tuple = ()):
     conn = get_db_connection()
     cur = conn.cursor()
@@ -174,47 +502,253 @@ def db_query(query: str, params: Tuple = ()):
     conn.close()
     return rows
 
+# -----------------------
+# Balance ledger: append-only entries in integer minor units + periodic snapshots
+# -----------------------
+# balance(user) = balance_snapshots.balance + SUM(ledger.amount after the snapshot's last_entry_id).
+# Writes are pure INSERTs; users.balance is only a mirror refreshed by the snapshot job
+# (leaderboards / browser), never read for money decisions.
+MONEY_SCALE = 100  # 1₫ = 100 minor units, so amt * WIN_MULTIPLIER stays exact to 0.01₫
+BALANCE_SNAPSHOT_INTERVAL = int(os.getenv("BALANCE_SNAPSHOT_INTERVAL", "60"))
+
+def to_minor(amount: float) -> int:
+    return int(round(float(amount) * MONEY_SCALE))
+
+def from_minor(amount: int) -> float:
+    return amount / MONEY_SCALE
+
+def balance_minor(conn, user_id: int) -> int:
+    snap = conn.execute("SELECT balance, last_entry_id FROM balance_snapshots WHERE user_id=?", (user_id,)).fetchone()
+    base, last_id = (snap["balance"], snap["last_entry_id"]) if snap else (0, 0)
+    delta = conn.execute("SELECT COALESCE(SUM(amount), 0) FROM ledger WHERE user_id=? AND id > ?", (user_id, last_id)).fetchone()[0]
+    return base + delta
+
+def get_balance(user_id: int) -> float:
+    """Committed balance, served from the user cache when no entry was posted since last read.
+    Money decisions still re-check with balance_minor() inside their transaction."""
+    cached = _cached_user(user_id, "balance")
+    if cached is not None:
+        return from_minor(cached)
+    conn = get_db_connection()
+    try:
+        minor = balance_minor(conn, user_id)
+    finally:
+        conn.close()
+    if user_id in _user_cache:
+        _cache_user(user_id, balance=minor)
+    return from_minor(minor)
+
+def post_ledger(conn, entries: List[Tuple[int, str, float, str]]):
+    """Append (user_id, kind, amount ₫ signed, ref) entries on an open transaction."""
+    ts = now_iso()
+    conn.executemany(
+        "INSERT INTO ledger(user_id, kind, amount, ref, created_at) VALUES (?, ?, ?, ?, ?)",
+        [(uid, kind, to_minor(amount), ref, ts) for uid, kind, amount, ref in entries]
+    )
+    for uid, _, _, _ in entries:
+        entry = _user_cache.get(uid)
+        if entry is not None:
+            entry.pop("balance", None)
+
+def debit_if_sufficient(conn, user_id: int, amount: float, kind: str, ref: str) -> bool:
+    """Check + insert inside the caller's BEGIN IMMEDIATE transaction (no lost updates)."""
+    if balance_minor(conn, user_id) < to_minor(amount):
+        return False
+    post_ledger(conn, [(user_id, kind, -amount, ref)])
+    return True
+
+def snapshot_balances(conn) -> int:
+    """Fold ledger entries newer than the last snapshot into balance_snapshots and the
+    users.balance mirror. Returns the number of users touched."""
+    wm = conn.execute("SELECT snapshot_id FROM ledger_meta WHERE id=1").fetchone()[0]
+    max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM ledger").fetchone()[0]
+    if max_id <= wm:
+        return 0
+    conn.execute(
+        """
+        INSERT INTO balance_snapshots(user_id, balance, last_entry_id)
+        SELECT user_id, SUM(amount), ? FROM ledger WHERE id > ? AND id <= ? GROUP BY user_id
+        ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance, last_entry_id = excluded.last_entry_id
+        """,
+        (max_id, wm, max_id)
+    )
+    touched = conn.execute(
+        """
+        UPDATE users SET balance = (SELECT s.balance FROM balance_snapshots s WHERE s.user_id = users.user_id) / ?
+        WHERE user_id IN (SELECT DISTINCT user_id FROM ledger WHERE id > ? AND id <= ?)
+        """,
+        (float(MONEY_SCALE), wm, max_id)
+    ).rowcount
+    conn.execute("UPDATE ledger_meta SET snapshot_id=? WHERE id=1", (max_id,))
+    return touched
+
+async def balance_snapshot_loop():
+    while True:
+        await asyncio.sleep(BALANCE_SNAPSHOT_INTERVAL)
+        try:
+            with db_transaction() as conn:
+                snapshot_balances(conn)
+        except Exception:
+            logger.exception("balance snapshot failed")
+
+def iter_ledger(user_id: Optional[int] = None, since_id: int = 0, chunk: int = 1000):
+    """Stream ledger rows in id order without loading the table (audits/exports)."""
+    conn = get_db_connection()
+    try:
+        while True:
+            if user_id is None:
+                rows = conn.execute("SELECT * FROM ledger WHERE id > ? ORDER BY id LIMIT ?", (since_id, chunk)).fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM ledger WHERE user_id=? AND id > ? ORDER BY id LIMIT ?", (user_id, since_id, chunk)).fetchall()
+            if not rows:
+                return
+            for r in rows:
+                yield r
+            since_id = rows[-1]["id"]
+    finally:
+        conn.close()
+
 # -----------------------
 # User helpers
 # -----------------------
 def now_iso():
     return datetime.utcnow().isoformat()
 
+def normalize_search_name(text: str) -> str:
+    """Lowercase, no leading @, no Vietnamese diacritics: 'Đức' -> 'duc'."""
+    text = (text or "").strip().lstrip("@").lower().replace("đ", "d")
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+def user_search_names(username: Optional[str], first_name: Optional[str]) -> Tuple[str, str]:
+    """(search_name, search_first) column values."""
+    return normalize_search_name(username or ""), normalize_search_name(first_name or "")
+
+# Bounded LRU of known users: {user_id: {"username", "first_name", "row"?, "balance"?}}.
+# "row" (users row minus balance) and "balance" (minor units) are optional and dropped by the
+# write paths: post_ledger forgets the balance, raw `UPDATE users` sites call invalidate_users().
+# Only touched from the event-loop thread, like the rest of the sync DB helpers.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+_user_cache: "collections.OrderedDict[int, Dict[str, Any]]" = collections.OrderedDict()
+_user_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def _cached_user(user_id: int, field: str):
+    entry = _user_cache.get(user_id)
+    if entry is None or field not in entry:
+        _user_cache_stats["misses"] += 1
+        return None
+    _user_cache.move_to_end(user_id)
+    _user_cache_stats["hits"] += 1
+    return entry[field]
+
+def _cache_user(user_id: int, **fields):
+    entry = _user_cache.get(user_id)
+    if entry is None:
+        entry = _user_cache[user_id] = {}
+        while len(_user_cache) > max(USER_CACHE_SIZE, 1):
+            _user_cache.popitem(last=False)
+            _user_cache_stats["evictions"] += 1
+    else:
+        _user_cache.move_to_end(user_id)
+    entry.update(fields)
+
+def invalidate_users(user_ids, balance: bool = False):
+    """Drop cached profile rows (and balances) after a write the cache did not see."""
+    for uid in user_ids:
+        entry = _user_cache.get(uid)
+        if entry is not None:
+            entry.pop("row", None)
+            if balance:
+                entry.pop("balance", None)
+
+def user_cache_metrics() -> List[str]:
+    lines = []
+    for key in ("hits", "misses", "evictions"):
+        lines += [f"# TYPE tx_user_cache_{key}_total counter", f"tx_user_cache_{key}_total {_user_cache_stats[key]}"]
+    lines += ["# TYPE tx_user_cache_entries gauge", f"tx_user_cache_entries {len(_user_cache)}"]
+    return lines
+
 def ensure_user(user_id: int, username: str = "", first_name: str = ""):
-    rows = db_query("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-    if not rows:
+    known = _cached_user(user_id, "username")
+    if known is not None:
+        cached = _user_cache[user_id]
+        if (not username or username == cached["username"]) and (not first_name or first_name == cached["first_name"]):
+            return
+        rows = [cached]
+    else:
+        conn = get_db_connection()
+        try:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO users(user_id, username, first_name, balance, total_deposited, total_bet_volume, current_streak, best_streak, created_at, start_bonus_given, start_bonus_progress, search_name, search_first) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, username or "", first_name or "", 0.0, 0.0, 0.0, 0, 0, now_iso(), 0, 0, *user_search_names(username, first_name))
+            ).rowcount
+            conn.commit()
+            rows = [] if inserted else conn.execute("SELECT username, first_name FROM users WHERE user_id=?", (user_id,)).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            _cache_user(user_id, username=username or "", first_name=first_name or "")
+            return
+    if (username and username != rows[0]["username"]) or (first_name and first_name != rows[0]["first_name"]):
+        # keep the browser's search index in step with renamed accounts
+        new_username = username or rows[0]["username"]
+        new_first = first_name or rows[0]["first_name"]
         db_execute(
-            "INSERT INTO users(user_id, username, first_name, balance, total_deposited, total_bet_volume, current_streak, best_streak, created_at, start_bonus_given, start_bonus_progress) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (user_id, username or "", first_name or "", 0.0, 0.0, 0.0, 0, 0, now_iso(), 0, 0)
+            "UPDATE users SET username=?, first_name=?, search_name=?, search_first=? WHERE user_id=?",
+            (new_username, new_first, *user_search_names(new_username, new_first), user_id)
         )
+        invalidate_users([user_id])
+        _cache_user(user_id, username=new_username, first_name=new_first)
+    else:
+        _cache_user(user_id, username=rows[0]["username"], first_name=rows[0]["first_name"])
 
 def get_user(user_id: int) -> Optional[Dict[str, Any]]:
-    rows = db_query("SELECT * FROM users WHERE user_id=?", (user_id,))
-    return dict(rows[0]) if rows else None
-
-def add_balance(user_id: int, amount: float):
+    row = _cached_user(user_id, "row")
+    if row is None:
+        rows = db_query("SELECT * FROM users WHERE user_id=?", (user_id,))
+        if not rows:
+            return None
+        row = dict(rows[0])
+        _cache_user(user_id, row=row, username=row["username"] or "", first_name=row["first_name"] or "")
+    u = dict(row)
+    u["balance"] = get_balance(user_id)  # users.balance is only the snapshot mirror
+    return u
+
+def add_balance(user_id: int, amount: float, kind: str = "adjust", ref: str = ""):
     ensure_user(user_id, "", "")
-    u = get_user(user_id)
-    new_bal = (u["balance"] or 0.0) + amount
-    db_execute("UPDATE users SET balance=? WHERE user_id=?", (new_bal, user_id))
-    return new_bal
+    with db_transaction() as conn:
+        post_ledger(conn, [(user_id, kind, amount, ref)])
+        return from_minor(balance_minor(conn, user_id))
 
 def set_balance(user_id: int, amount: float):
     ensure_user(user_id, "", "")
-    db_execute("UPDATE users SET balance=? WHERE user_id=?", (amount, user_id))
-
-def add_to_pot(amount: float):
-    rows = db_query("SELECT amount FROM pot WHERE id=1")
-    current = rows[0]["amount"] if rows else 0.0
-    new = current + amount
-    db_execute("UPDATE pot SET amount=? WHERE id=1", (new,))
-
-def get_pot_amount() -> float:
-    rows = db_query("SELECT amount FROM pot WHERE id=1")
-    return rows[0]["amount"] if rows else 0.0
-
-def reset_pot():
-    db_execute("UPDATE pot SET amount=? WHERE id=1", (0.0,))
+    with db_transaction() as conn:
+        delta = to_minor(amount) - balance_minor(conn, user_id)
+        if delta:
+            post_ledger(conn, [(user_id, "adjust", from_minor(delta), "set_balance")])
+
+# Pot ("hũ") is split into per-group shards (minor units) so concurrent settlements of
+# different groups touch different rows; the pot is the SUM of the shards.
+def add_to_pot(amount: float, chat_id: int = 0, conn=None):
+    query = ("INSERT INTO pot_shards(chat_id, amount) VALUES (?, ?) "
+             "ON CONFLICT(chat_id) DO UPDATE SET amount = amount + excluded.amount")
+    if conn is not None:
+        conn.execute(query, (chat_id, to_minor(amount)))
+    else:
+        db_execute(query, (chat_id, to_minor(amount)))
+
+def get_pot_amount(conn=None) -> float:
+    """Pass the open transaction's connection to read a snapshot consistent with it."""
+    if conn is not None:
+        return from_minor(conn.execute("SELECT COALESCE(SUM(amount), 0) FROM pot_shards").fetchone()[0])
+    rows = db_query("SELECT COALESCE(SUM(amount), 0) AS total FROM pot_shards")
+    return from_minor(rows[0]["total"])
+
+def reset_pot(conn=None):
+    if conn is not None:
+        conn.execute("UPDATE pot_shards SET amount=0")
+    else:
+        db_execute("UPDATE pot_shards SET amount=0")
 
 # -----------------------
 # Dice logic
@@ -223,8 +757,52 @@ DICE_CHARS = ["\u2680", "\u2681", "\u2682", "\u2683", "\u2684", "\u2685"]
 WHITE = "⚪"  # Xỉu
 BLACK = "⚫"  # Tài
 
+DICE_BUFFER_BYTES = int(os.getenv("DICE_BUFFER_BYTES", "65536"))
+
+class DiceSource:
+    """Uniform 1-6 from the OS CSPRNG. Reads os.urandom in blocks of `block` bytes and keeps
+    bytes < 252 (the largest multiple of 6 that fits in a byte), mapping them to b % 6 + 1, so
+    there is no modulo bias. One shared buffer serves every group; a lock makes it thread-safe
+    (rounds run on the loop, dicetest / replay may call from threads)."""
+
+    ACCEPT_BELOW = 252
+
+    def __init__(self, block: int = DICE_BUFFER_BYTES):
+        self.block = max(block, 64)
+        self._lock = threading.Lock()
+        self._buf = b""
+        self._pos = 0
+        self.refills = 0
+
+    def _refill(self):
+        raw = np.frombuffer(os.urandom(self.block), dtype=np.uint8)
+        self._buf = (raw[raw < self.ACCEPT_BELOW] % 6 + 1).tobytes()
+        self._pos = 0
+        self.refills += 1
+
+    def roll(self) -> int:
+        with self._lock:
+            if self._pos >= len(self._buf):
+                self._refill()
+            v = self._buf[self._pos]
+            self._pos += 1
+            return v
+
+    def rolls(self, n: int) -> List[int]:
+        out = []
+        with self._lock:
+            while len(out) < n:
+                if self._pos >= len(self._buf):
+                    self._refill()
+                take = self._buf[self._pos:self._pos + n - len(out)]
+                self._pos += len(take)
+                out.extend(take)
+        return out
+
+dice_source = DiceSource()
+
 def roll_one_die() -> int:
-    return random.randint(1, 6)
+    return dice_source.roll()
 
 def roll_three_dice_random() -> Tuple[List[int], int, Optional[str]]:
     a = roll_one_die()
@@ -257,25 +835,98 @@ def decide_result_by_time_rule(round_epoch: int) -> str:
 # -----------------------
 # Chat lock/unlock and countdown
 # -----------------------
-async def lock_group_chat(bot, chat_id: int):
+# Per-chat permission cache: the state we last applied and whether the bot may restrict members.
+# Redundant set_chat_permissions calls are skipped; chats where the bot lacks rights (or calls
+# keep failing) back off instead of spending two API calls per round on a guaranteed error.
+CHAT_RIGHTS_RECHECK = int(os.getenv("CHAT_RIGHTS_RECHECK", "3600"))  # seconds between get_chat_member checks
+CHAT_LOCK_MAX_BACKOFF = int(os.getenv("CHAT_LOCK_MAX_BACKOFF", "3600"))
+_chat_perms: Dict[int, Dict[str, Any]] = {}  # chat_id -> {"locked", "can_restrict", "checked_at", "failures", "retry_at"}
+_chat_perm_stats = {"calls": 0, "skipped_same": 0, "skipped_no_rights": 0, "skipped_backoff": 0, "failures": 0}
+
+UNLOCKED_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_media_messages=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True
+)
+LOCKED_PERMISSIONS = ChatPermissions(can_send_messages=False)
+
+def _chat_perm_state(chat_id: int) -> Dict[str, Any]:
+    state = _chat_perms.get(chat_id)
+    if state is None:
+        state = _chat_perms[chat_id] = {"locked": None, "can_restrict": None, "checked_at": 0.0, "failures": 0, "retry_at": 0.0}
+    return state
+
+async def bot_can_restrict(bot, chat_id: int, state: Dict[str, Any]) -> Optional[bool]:
+    """Cached: is the bot an admin allowed to restrict members? None if Telegram could not say."""
+    now = time.monotonic()
+    if state["can_restrict"] is not None and now - state["checked_at"] < CHAT_RIGHTS_RECHECK:
+        return state["can_restrict"]
     try:
-        perms = ChatPermissions(can_send_messages=False)
-        await bot.set_chat_permissions(chat_id=chat_id, permissions=perms)
-    except Exception:
-        pass
+        member = await bot.get_chat_member(chat_id=chat_id, user_id=bot.id)
+        state["can_restrict"] = member.status == "creator" or (
+            member.status == "administrator" and bool(getattr(member, "can_restrict_members", False))
+        )
+    except Exception as e:
+        logger.debug(f"get_chat_member({chat_id}) failed: {e}")
+        state["can_restrict"] = None
+    state["checked_at"] = now
+    return state["can_restrict"]
+
+async def set_group_locked(bot, chat_id: int, locked: bool):
+    state = _chat_perm_state(chat_id)
+    if state["locked"] is locked:
+        _chat_perm_stats["skipped_same"] += 1
+        return
+    now = time.monotonic()
+    # backoff only holds back locking; an unlock is retried at every round end (fail open),
+    # otherwise one transient error would keep the group muted for the whole backoff
+    if locked and now < state["retry_at"]:
+        _chat_perm_stats["skipped_backoff"] += 1
+        return
+    if await bot_can_restrict(bot, chat_id, state) is False:
+        _chat_perm_stats["skipped_no_rights"] += 1
+        return
+    _chat_perm_stats["calls"] += 1
+    try:
+        await bot.set_chat_permissions(chat_id=chat_id, permissions=LOCKED_PERMISSIONS if locked else UNLOCKED_PERMISSIONS)
+    except RetryAfter as e:
+        _chat_perm_stats["failures"] += 1
+        state["retry_at"] = now + float(e.retry_after)
+        if not locked:
+            state["locked"] = True  # still (maybe) muted: the next unlock must not be skipped as "same"
+        return
+    except Exception as e:
+        _chat_perm_stats["failures"] += 1
+        state["failures"] += 1
+        state["locked"] = None if locked else True
+        state["can_restrict"] = None  # re-ask Telegram before the next attempt
+        backoff = min(ROUND_SECONDS * 2 ** (state["failures"] - 1), CHAT_LOCK_MAX_BACKOFF)
+        state["retry_at"] = now + backoff
+        if state["failures"] == 1:
+            logger.warning(f"Không đổi được quyền chat {chat_id} ({e}); thử lại sau {backoff}s")
+        return
+    state["locked"] = locked
+    state["failures"] = 0
+
+async def lock_group_chat(bot, chat_id: int):
+    await set_group_locked(bot, chat_id, True)
 
 async def unlock_group_chat(bot, chat_id: int):
-    try:
-        perms = ChatPermissions(
-            can_send_messages=True,
-            can_send_media_messages=True,
-            can_send_polls=True,
-            can_send_other_messages=True,
-            can_add_web_page_previews=True
-        )
-        await bot.set_chat_permissions(chat_id=chat_id, permissions=perms)
-    except Exception:
-        pass
+    await set_group_locked(bot, chat_id, False)
+
+async def my_chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Bot promoted / demoted / removed: drop the cached rights so the next round re-checks."""
+    change = update.my_chat_member
+    if change:
+        _chat_perms.pop(change.chat.id, None)
+
+def chat_perm_metrics() -> List[str]:
+    lines = []
+    for key, value in _chat_perm_stats.items():
+        lines += [f"# TYPE tx_chat_permissions_{key}_total counter", f"tx_chat_permissions_{key}_total {value}"]
+    return lines
 
 async def send_countdown(bot, chat_id: int, seconds: int):
     try:
@@ -306,8 +957,9 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = get_user(user.id)
     greeted = False
     if u and u.get("start_bonus_given", 0) == 0:
-        add_balance(user.id, START_BONUS)
+        add_balance(user.id, START_BONUS, "bonus", "start")
         db_execute("UPDATE users SET total_deposited=COALESCE(total_deposited,0)+?, start_bonus_given=1, start_bonus_progress=0 WHERE user_id=?", (START_BONUS, user.id))
+        invalidate_users([user.id])
         greeted = True
 
     text = f"Xin chào {user.first_name or 'bạn'}! 👋\nChào mừng đến phòng Tài Xỉu tự động.\n"
@@ -345,21 +997,61 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
 # -----------------------
 # Withdraw handlers
 # -----------------------
+def withdraw_day() -> str:
+    return datetime.utcnow().date().isoformat()
+
+def withdrawn_today(user_id: int) -> float:
+    # O(1) primary-key lookup in the running-total table (no scan of withdrawals)
+    rows = db_query("SELECT total FROM withdrawal_daily WHERE user_id=? AND day=?", (user_id, withdraw_day()))
+    return rows[0]["total"] if rows else 0.0
+
+def approve_withdrawal(wid: int, admin_id: int) -> Tuple[str, Optional[sqlite3.Row]]:
+    """Debit, mark approved and bump the daily total in one transaction.
+    Returns (outcome, withdrawal row): ok | handled | limit | balance | missing."""
+    with db_transaction() as conn:
+        w = conn.execute("SELECT * FROM withdrawals WHERE id=?", (wid,)).fetchone()
+        if w is None:
+            return "missing", None
+        if w["status"] != "pending":
+            return "handled", w
+        day = withdraw_day()
+        row = conn.execute("SELECT total FROM withdrawal_daily WHERE user_id=? AND day=?", (w["user_id"], day)).fetchone()
+        if (row["total"] if row else 0.0) + w["amount"] > WITHDRAW_DAILY_LIMIT:
+            conn.execute("UPDATE withdrawals SET status='rejected', decided_at=?, decided_by=? WHERE id=?", (now_iso(), admin_id, wid))
+            return "limit", w
+        if not debit_if_sufficient(conn, w["user_id"], w["amount"], "withdrawal", str(wid)):
+            conn.execute("UPDATE withdrawals SET status='rejected', decided_at=?, decided_by=? WHERE id=?", (now_iso(), admin_id, wid))
+            return "balance", w
+        conn.execute(
+            "INSERT INTO withdrawal_daily(user_id, day, total) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id, day) DO UPDATE SET total = total + excluded.total",
+            (w["user_id"], day, w["amount"])
+        )
+        conn.execute("UPDATE withdrawals SET status='approved', decided_at=?, decided_by=? WHERE id=?", (now_iso(), admin_id, wid))
+        return "ok", w
+
+def reject_withdrawal(wid: int, admin_id: int) -> Tuple[str, Optional[sqlite3.Row]]:
+    with db_transaction() as conn:
+        w = conn.execute("SELECT * FROM withdrawals WHERE id=?", (wid,)).fetchone()
+        if w is None:
+            return "missing", None
+        if w["status"] != "pending":
+            return "handled", w
+        conn.execute("UPDATE withdrawals SET status='rejected', decided_at=?, decided_by=? WHERE id=?", (now_iso(), admin_id, wid))
+        return "ok", w
+
 async def withdraw_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     parts = (query.data or "").split("|")
-    if len(parts) < 5:
+    if len(parts) != 2:
         await query.edit_message_text("Dữ liệu không hợp lệ.")
         return
 
     action = parts[0]
     try:
-        user_id = int(parts[1])
-        amount = int(parts[2])
-        bank = parts[3]
-        account = parts[4]
-    except:
+        wid = int(parts[1])
+    except ValueError:
         await query.edit_message_text("Dữ liệu không hợp lệ.")
         return
 
@@ -368,165 +1060,232 @@ async def withdraw_callback_handler(update: Update, context: ContextTypes.DEFAUL
         await query.edit_message_text("Chỉ admin mới thao tác.")
         return
 
-    # ✅ Nếu admin duyệt rút tiền
     if action == "withdraw_ok":
-        u = get_user(user_id)
-        if not u:
-            await query.edit_message_text("User không tồn tại.")
-            return
-
-        # 📌 1️⃣ Kiểm tra số dư
-        if u["balance"] < amount:
-            await query.edit_message_text("User không đủ tiền.")
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"❌ Yêu cầu rút {amount:,}₫ bị từ chối: số dư không đủ."
-                )
-            except:
-                pass
-            return
-
-        # 📌 2️⃣ Giới hạn rút tối đa 1.000.000đ/ngày
-        today = datetime.utcnow().date()
-        total_today = db_query_one(
-            "SELECT COALESCE(SUM(amount), 0) FROM withdrawals WHERE user_id=? AND DATE(created_at)=?",
-            (user_id, today.isoformat())
-        )[0]
-
-        if total_today + amount > 1_000_000:
-            await query.edit_message_text(f"Yêu cầu rút {amount:,}₫ bị từ chối (vượt giới hạn 1.000.000đ/ngày).")
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"❌ Bạn đã vượt giới hạn rút tối đa 1.000.000₫ trong ngày. Hãy thử lại vào ngày mai."
-                )
-            except:
-                pass
-            return
+        outcome, w = approve_withdrawal(wid, query.from_user.id)
+    else:
+        outcome, w = reject_withdrawal(wid, query.from_user.id)
 
-        # 📌 3️⃣ Cập nhật số dư
-        new_bal = u["balance"] - amount
-        db_execute("UPDATE users SET balance=? WHERE user_id=?", (new_bal, user_id))
+    if outcome == "missing":
+        await query.edit_message_text("Yêu cầu rút không tồn tại.")
+        return
+    if outcome == "handled":
+        await query.edit_message_text(f"Yêu cầu #{wid} đã được xử lý trước đó ({w['status']}).")
+        return
 
-        # 📌 4️⃣ Ghi lịch sử rút
-        db_execute(
-            "INSERT INTO withdrawals (user_id, amount, created_at) VALUES (?, ?, ?)",
-            (user_id, amount, datetime.utcnow().isoformat())
-        )
+    user_id, amount = w["user_id"], int(w["amount"])
+    if action != "withdraw_ok":
+        admin_text = f"Yêu cầu rút {amount:,}₫ đã bị từ chối bởi admin {query.from_user.id}."
+        user_text = f"❌ Yêu cầu rút {amount:,}₫ đã bị từ chối."
+    elif outcome == "balance":
+        admin_text = "User không đủ tiền."
+        user_text = f"❌ Yêu cầu rút {amount:,}₫ bị từ chối: số dư không đủ."
+    elif outcome == "limit":
+        admin_text = f"Yêu cầu rút {amount:,}₫ bị từ chối (vượt giới hạn {WITHDRAW_DAILY_LIMIT:,}₫/ngày)."
+        user_text = f"❌ Bạn đã vượt giới hạn rút tối đa {WITHDRAW_DAILY_LIMIT:,}₫ trong ngày. Hãy thử lại vào ngày mai."
+    else:
+        admin_text = f"✅ Đã xác nhận rút {amount:,}₫ cho user {user_id}."
+        user_text = f"✅ Yêu cầu rút {amount:,}₫ đã được duyệt bởi admin.\nNgân hàng: {w['bank']}\nSố TK: {w['account']}"
 
-        # 📌 5️⃣ Gửi thông báo
-        await query.edit_message_text(f"✅ Đã xác nhận rút {amount:,}₫ cho user {user_id}.")
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"✅ Yêu cầu rút {amount:,}₫ đã được duyệt bởi admin.\nNgân hàng: {bank}\nSố TK: {account}"
-            )
-        except:
-            pass
+    await query.edit_message_text(admin_text)
+    try:
+        await context.bot.send_message(chat_id=user_id, text=user_text)
+    except Exception:
+        pass
 
-    # ❌ Nếu admin từ chối
-    else:
-        await query.edit_message_text(
-            f"Yêu cầu rút {amount:,}₫ đã bị từ chối bởi admin {query.from_user.id}."
-        )
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"❌ Yêu cầu rút {amount:,}₫ đã bị từ chối."
-            )
-        except:
-            pass
-        
 # -----------------------------
 # ✅ BET HANDLER (T/X + /T/X)
 # -----------------------------
-async def bet_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = update.message
-    if not msg or not msg.text:
-        return
-
-    text = msg.text.strip()
-    # ✅ Chấp nhận cả /T1000, /X1000 và T1000, X1000
-    if text.startswith("/"):
-        cmd = text[1:]
+def place_bet(chat_id: int, round_id: str, user_id: int, side: str, amount: float) -> bool:
+    """Debit, bump total_bet_volume and add the bet to the user's position atomically;
+    False if balance is short."""
+    with db_transaction() as conn:
+        if not debit_if_sufficient(conn, user_id, amount, "bet", round_id):
+            return False
+        conn.execute("UPDATE users SET total_bet_volume = COALESCE(total_bet_volume, 0) + ? WHERE user_id=?", (amount, user_id))
+        conn.execute(
+            """
+            INSERT INTO bets(chat_id, round_id, user_id, side, amount, timestamp, bet_count) VALUES (?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT(chat_id, round_id, user_id, side) DO UPDATE SET
+                amount = amount + excluded.amount, bet_count = bet_count + 1, timestamp = excluded.timestamp
+            """,
+            (chat_id, round_id, user_id, side, amount, now_iso())
+        )
+    invalidate_users([user_id])
+    return True
+
+# /T1000, T1000, /T1000@bot, X 5k, T1.5k, T1tr, X 1.000 / 1,000,000 (hàng nghìn: nhóm 3 chữ số),
+# T all / X tất tay (phải có khoảng trắng: "Tall" không phải lệnh cược)
+BET_FIRST_CHARS = frozenset("/TtXx")
+BET_PATTERN = re.compile(
+    r"/?(?P<side>[TtXx])(?:\s+(?P<all>all-?in|all|tất tay|tat tay)|\s*(?P<num>\d+(?:[.,]\d+)*)\s*(?P<unit>k|tr|m)?)(?:@\w+)?\s*$",
+    re.IGNORECASE
+)
+BET_THOUSANDS = re.compile(r"\d{1,3}([.,])\d{3}(?:\1\d{3})*")
+BET_UNITS = {"k": 1_000, "tr": 1_000_000, "m": 1_000_000}
+
+def parse_bet(m: "re.Match") -> Tuple[str, Optional[int]]:
+    """(side, amount) from a BET_PATTERN match; amount None = all-in.
+    Separators are thousands groups ("1.000", "1,000,000"); with a unit a single one is the
+    decimal point ("1.5k", "2,01k"). Raises ValueError for anything else, or a fraction of 1₫."""
+    side = "tai" if m["side"] in "Tt" else "xiu"
+    if m["all"]:
+        return side, None
+    num, unit = m["num"], (m["unit"] or "").lower()
+    separators = num.count(".") + num.count(",")
+    if not separators:
+        value = Decimal(num)
+    elif unit and separators == 1:
+        value = Decimal(num.replace(",", "."))
+    elif BET_THOUSANDS.fullmatch(num):
+        value = Decimal(num.replace(".", "").replace(",", ""))
     else:
-        cmd = text
-
-    if len(cmd) < 2:
-        return
-
-    prefix = cmd[0].lower()
-    if prefix not in ("t", "x"):
-        return
+        raise ValueError(num)
+    amount = value * BET_UNITS.get(unit, 1)
+    if amount != amount.to_integral_value():
+        raise ValueError(num)
+    return side, int(amount)
+
+class BetMessageFilter(filters.MessageFilter):
+    """Routes bet texts to bet_message_handler with one anchored regex, after a first-byte check
+    so ordinary group chatter costs one set lookup. Data filter: the match lands in context.matches.
+    The bare form ("T1000", no slash) is also how people write "x2" or "t5", so it is only routed
+    from groups and with a valid amount of at least MIN_BET; anything else is left as chatter."""
+    data_filter = True
+
+    def filter(self, message) -> Optional[Dict[str, List["re.Match"]]]:
+        text = message.text
+        if not text or text[0] not in BET_FIRST_CHARS:
+            return None
+        m = BET_PATTERN.match(text)
+        if not m:
+            return None
+        if text[0] != "/":
+            if message.chat.type not in ("group", "supergroup"):
+                return None
+            try:
+                _, amount = parse_bet(m)
+            except ValueError:
+                return None
+            if amount is not None and amount < MIN_BET:
+                return None
+        return {"matches": [m]}
 
-    side = "tai" if prefix == "t" else "xiu"
+BET_FILTER = BetMessageFilter(name="BetMessageFilter")
 
-    # ✅ Parse tiền cược
-    try:
-        amount = int(cmd[1:])
-    except:
-        await msg.reply_text("❌ Cú pháp đặt cược sai. Ví dụ: /T1000 hoặc X5000")
+async def bet_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    if not msg or not msg.text:
         return
 
-    if amount < MIN_BET:
-        await msg.reply_text(f"⚠️ Đặt cược tối thiểu {MIN_BET:,}₫")
+    # ✅ Đã parse sẵn bởi BET_FILTER: /T1000, T1000, X 5k, T1tr, T all...
+    m = context.matches[0] if context.matches else BET_PATTERN.match(msg.text)
+    if not m:
         return
-
+    # only the explicit /T /X command form gets told why it was refused; a bare "T 500" in a
+    # chat that is not playing is just conversation
+    command = msg.text.startswith("/")
     user = update.effective_user
     chat = update.effective_chat
 
     # ✅ Chỉ cho phép cược trong group
     if chat.type not in ("group", "supergroup"):
-        await msg.reply_text("Lệnh cược chỉ dùng trong nhóm.")
+        if command:
+            await msg.reply_text("Lệnh cược chỉ dùng trong nhóm.")
         return
 
     # ✅ Kiểm tra nhóm đã duyệt & đang chạy
     g = db_query("SELECT approved, running FROM groups WHERE chat_id=?", (chat.id,))
     if not g or g[0]["approved"] != 1 or g[0]["running"] != 1:
-        await msg.reply_text("Nhóm này chưa được admin duyệt hoặc chưa bật /batdau.")
+        if command:
+            await msg.reply_text("Nhóm này chưa được admin duyệt hoặc chưa bật /batdau.")
         return
 
-    ensure_user(user.id, user.username or "", user.first_name or "")
-    u = get_user(user.id)
-    if not u or (u["balance"] or 0.0) < amount:
-        await msg.reply_text("❌ Số dư không đủ.")
+    try:
+        side, amount = parse_bet(m)
+    except ValueError:
+        if command:
+            await msg.reply_text("⚠️ Số tiền không hợp lệ. Ví dụ: T1000, X 5k, T1.5k, X 1.000.000")
         return
 
-    # ✅ Trừ tiền ngay & cộng tổng cược
-    new_balance = (u["balance"] or 0.0) - amount
-    new_total_bet = (u["total_bet_volume"] or 0.0) + amount
-    db_execute(
-        "UPDATE users SET balance=?, total_bet_volume=? WHERE user_id=?",
-        (new_balance, new_total_bet, user.id)
-    )
+    if amount is not None and amount < MIN_BET:
+        if command:
+            await msg.reply_text(f"⚠️ Đặt cược tối thiểu {MIN_BET:,}₫")
+        return
+
+    ensure_user(user.id, user.username or "", user.first_name or "")
+    if amount is None:
+        # tất tay: toàn bộ số dư (phần nguyên), chỉ đặt khi người chơi bấm xác nhận
+        amount = int(get_balance(user.id))
+        if amount < MIN_BET:
+            await msg.reply_text(f"❌ Số dư không đủ cược tối thiểu {MIN_BET:,}₫.")
+            return
+        round_epoch = int(datetime.utcnow().timestamp()) // ROUND_SECONDS
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton(f"✅ Tất tay {amount:,}₫", callback_data=f"allin|{side}|{user.id}|{round_epoch}|{amount}"),
+            InlineKeyboardButton("❌ Hủy", callback_data=f"allin|no|{user.id}"),
+        ]])
+        await msg.reply_text(f"Xác nhận đặt {side.upper()} tất tay {amount:,}₫ cho phiên hiện tại?", reply_markup=keyboard)
+        return
 
-    # ✅ Lưu cược vào DB
+    # ✅ Trừ tiền (ledger) + cộng tổng cược + lưu cược: 1 transaction
     now_ts = int(datetime.utcnow().timestamp())
     round_epoch = now_ts // ROUND_SECONDS
     round_id = f"{chat.id}_{round_epoch}"
-    db_execute(
-        "INSERT INTO bets(chat_id, round_id, user_id, side, amount, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-        (chat.id, round_id, user.id, side, amount, now_iso())
-    )
-
-    # ✅ Update bonus start progress nếu có
-    try:
-        rows = db_query("SELECT start_bonus_given, start_bonus_progress FROM users WHERE user_id=?", (user.id,))
-        if rows and rows[0]["start_bonus_given"] == 1:
-            new_prog = (rows[0]["start_bonus_progress"] or 0) + 1
-            db_execute("UPDATE users SET start_bonus_progress=? WHERE user_id=?", (new_prog, user.id))
-    except Exception:
-        logger.exception("start bonus progress update failed")
+    set_log_context(chat_id=chat.id, round_id=round_id, user_id=user.id)
+    # cached balance rejects obviously-short bets without a write transaction; place_bet re-checks
+    if get_balance(user.id) < amount or not place_bet(chat.id, round_id, user.id, side, amount):
+        await msg.reply_text("❌ Số dư không đủ.")
+        return
 
-    # ✅ Update promo wager progress nếu có
-    try:
-        await update_promo_wager_progress(context, user.id, round_id)
-    except Exception:
-        logger.exception("promo progress failed")
+    # (tiến độ cược thưởng /start & code được tính 1 lần/phiên khi quyết toán)
 
     # ✅ Phản hồi không kèm số dư
     await msg.reply_text(f"✅ Đã đặt {side.upper()} {amount:,}₫ cho phiên hiện tại.")
+
+async def allin_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """allin|<tai|xiu>|<user_id>|<round_epoch>|<amount> or allin|no|<user_id>: only the bettor may
+    confirm, and only for the round (and amount) the prompt was shown for."""
+    query = update.callback_query
+    parts = (query.data or "").split("|")
+    try:
+        uid = int(parts[2])
+    except (IndexError, ValueError):
+        await query.answer()
+        await query.edit_message_text("Dữ liệu không hợp lệ.")
+        return
+    if query.from_user.id != uid:
+        await query.answer("Đây không phải lệnh của bạn.", show_alert=True)
+        return
+    await query.answer()
+    if parts[1] == "no":
+        await query.edit_message_text("Đã hủy lệnh tất tay.")
+        return
+    try:
+        side, round_epoch, amount = parts[1], int(parts[3]), int(parts[4])
+    except (IndexError, ValueError):
+        await query.edit_message_text("Dữ liệu không hợp lệ.")
+        return
+    if side not in ("tai", "xiu"):
+        await query.edit_message_text("Dữ liệu không hợp lệ.")
+        return
+
+    chat_id = query.message.chat.id
+    now_ts = int(datetime.utcnow().timestamp())
+    # the chat is locked for the last 5s of a round (send_countdown); buttons must not bypass that
+    if now_ts // ROUND_SECONDS != round_epoch or now_ts % ROUND_SECONDS >= ROUND_SECONDS - 5:
+        await query.edit_message_text("⌛ Phiên đã khóa cược, lệnh tất tay bị hủy.")
+        return
+    g = db_query("SELECT approved, running FROM groups WHERE chat_id=?", (chat_id,))
+    if not g or g[0]["approved"] != 1 or g[0]["running"] != 1:
+        await query.edit_message_text("Nhóm này chưa được admin duyệt hoặc chưa bật /batdau.")
+        return
+
+    round_id = f"{chat_id}_{round_epoch}"
+    set_log_context(chat_id=chat_id, round_id=round_id, user_id=uid)
+    if get_balance(uid) < amount or not place_bet(chat_id, round_id, uid, side, amount):
+        await query.edit_message_text("❌ Số dư không đủ.")
+        return
+    await query.edit_message_text(f"✅ Đã đặt {side.upper()} tất tay {amount:,}₫ cho phiên hiện tại.")
 # -----------------------
 # Admin handlers
 # -----------------------
@@ -544,33 +1303,213 @@ async def addmoney_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Tham số không hợp lệ.")
         return
     ensure_user(uid, "", "")
-    new_bal = add_balance(uid, amt)
+    new_bal = add_balance(uid, amt, "deposit", f"admin:{update.effective_user.id}")
     db_execute("UPDATE users SET total_deposited=COALESCE(total_deposited,0)+? WHERE user_id=?", (amt, uid))
+    invalidate_users([uid])
     await update.message.reply_text(f"Đã cộng {int(amt):,}₫ cho user {uid}. Số dư hiện: {int(new_bal):,}₫")
     try:
         await context.bot.send_message(chat_id=uid, text=f"Bạn vừa được admin cộng {int(amt):,}₫. Số dư: {int(new_bal):,}₫")
     except:
         pass
 
+LEADERBOARDS = {
+    "nap": ("total_deposited", "Top {n} nạp nhiều nhất"),
+    "sodu": ("balance", "Top {n} số dư"),
+    "cuoc": ("total_bet_volume", "Top {n} tổng cược"),
+    "chuoi": ("best_streak", "Top {n} chuỗi thắng"),
+}
+
+def get_balance_leaderboard(limit: int) -> List[Dict[str, Any]]:
+    """Top balances from snapshot + ledger tail (users.balance is only a lagging mirror).
+    Users without entries after the snapshot watermark rank by their snapshot, read off
+    idx_balance_snapshots_balance; the few touched since are priced live and merged in."""
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN")  # one read snapshot: no fold can land between the queries
+        wm = conn.execute("SELECT snapshot_id FROM ledger_meta WHERE id=1").fetchone()[0]
+        live = {
+            r["user_id"]: r["balance"]
+            for r in conn.execute(
+                """
+                SELECT t.user_id, COALESCE(s.balance, 0) + t.tail AS balance
+                FROM (SELECT user_id, SUM(amount) AS tail FROM ledger WHERE id > ? GROUP BY user_id) t
+                LEFT JOIN balance_snapshots s ON s.user_id = t.user_id
+                """,
+                (wm,)
+            )
+        }
+        ranked = list(live.items())
+        for r in conn.execute(
+            "SELECT user_id, balance FROM balance_snapshots ORDER BY balance DESC, user_id LIMIT ?",
+            (limit + len(live),)
+        ):
+            if r["user_id"] not in live:
+                ranked.append((r["user_id"], r["balance"]))
+        conn.rollback()
+    finally:
+        conn.close()
+    ranked.sort(key=lambda kv: (-kv[1], kv[0]))
+    return [{"user_id": uid, "value": from_minor(bal)} for uid, bal in ranked[:limit]]
+
+def get_leaderboard(column: str, limit: int) -> List[sqlite3.Row]:
+    if column == "balance":
+        return get_balance_leaderboard(limit)
+    # ORDER BY the bare column so the idx_users_<column> index is walked (no COALESCE here)
+    return db_query(f"SELECT user_id, {column} AS value FROM users ORDER BY {column} DESC LIMIT ?", (limit,))
+
+def format_leaderboard(board: str, limit: int, bullet: bool = False) -> str:
+    column, title = LEADERBOARDS[board]
+    rows = get_leaderboard(column, limit)
+    suffix = "" if column == "best_streak" else "₫"
+    lines = [title.format(n=limit) + ":"]
+    for i, r in enumerate(rows, start=1):
+        prefix = "-" if bullet else f"{i}."
+        lines.append(f"{prefix} {r['user_id']} — {int(r['value'] or 0):,}{suffix}")
+    return "\n".join(lines)
+
 async def top10_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/top10 [nap|sodu|cuoc|chuoi] — mặc định: nạp nhiều nhất."""
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("Chỉ admin.")
         return
-    rows = db_query("SELECT user_id, total_deposited FROM users ORDER BY total_deposited DESC LIMIT 10")
-    text = "Top 10 nạp nhiều nhất:\n"
-    for i, r in enumerate(rows, start=1):
-        text += f"{i}. {r['user_id']} — {int(r['total_deposited'] or 0):,}₫\n"
-    await update.message.reply_text(text)
+    board = context.args[0].lower() if context.args else "nap"
+    if board not in LEADERBOARDS:
+        await update.message.reply_text("Cú pháp: /top10 [nap|sodu|cuoc|chuoi]")
+        return
+    await update.message.reply_text(format_leaderboard(board, 10))
 
 async def balances_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("Chỉ admin.")
         return
-    rows = db_query("SELECT user_id, balance FROM users ORDER BY balance DESC LIMIT 50")
-    text = "Top balances:\n"
+    await update.message.reply_text(format_leaderboard("sodu", 50, bullet=True))
+
+# -----------------------
+# Admin user browser (/users [tên]) — keyset pagination
+# -----------------------
+USER_PAGE_SIZE = int(os.getenv("USER_PAGE_SIZE", "20"))
+
+def fetch_user_page(query: str, direction: str, cursor_uid: Optional[int], limit: int = USER_PAGE_SIZE):
+    """One page after/before `cursor_uid`. Browsing walks the primary key; searching merges
+    range scans of idx_users_search (username) and idx_users_search_first (first_name), ordered
+    by the matched name, a user whose username matches being listed under it only. Both seek
+    straight to the cursor instead of using OFFSET."""
+    forward = direction != "p"
+    op, order = (">", "ASC") if forward else ("<", "DESC")
+    if not query:
+        sql = "SELECT user_id, username, first_name, balance FROM users"
+        params: Tuple = ()
+        if cursor_uid is not None:
+            sql += f" WHERE user_id {op} ?"
+            params = (cursor_uid,)
+        rows = db_query(sql + f" ORDER BY user_id {order} LIMIT ?", params + (limit + 1,))
+    else:
+        hi = query + "\uffff"
+        seek = ("", -1) if forward else (hi, 1 << 62)
+        if cursor_uid is not None:
+            # the cursor's sort key is the name it was listed under
+            rows = db_query("SELECT search_name, search_first FROM users WHERE user_id=?", (cursor_uid,))
+            if rows:
+                name, first = rows[0]["search_name"] or "", rows[0]["search_first"] or ""
+                seek = (name if query <= name < hi else first, cursor_uid)
+        rows = db_query(
+            f"""
+            SELECT user_id, username, first_name, balance, search_name AS k FROM users
+            WHERE search_name >= ? AND search_name < ? AND (search_name, user_id) {op} (?, ?)
+            UNION ALL
+            SELECT user_id, username, first_name, balance, search_first AS k FROM users
+            WHERE search_first >= ? AND search_first < ? AND (search_first, user_id) {op} (?, ?)
+              AND NOT (search_name >= ? AND search_name < ?)
+            ORDER BY k {order}, user_id {order} LIMIT ?
+            """,
+            (query, hi, *seek, query, hi, *seek, query, hi, limit + 1)
+        )
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not forward:
+        rows.reverse()
+    has_prev = more if not forward else cursor_uid is not None
+    has_next = more if forward else True
+    return rows, has_prev, has_next
+
+def render_user_page(query: str, direction: str, cursor_uid: Optional[int]):
+    rows, has_prev, has_next = fetch_user_page(query, direction, cursor_uid)
+    title = f"Người dùng khớp '{query}':" if query else "Người dùng:"
+    lines = [title]
+    for r in rows:
+        name = f"@{r['username']}" if r["username"] else (r["first_name"] or "-")
+        lines.append(f"{r['user_id']} — {name} — {int(r['balance'] or 0):,}₫")
+    if not rows:
+        lines.append("(không có)")
+    buttons = []
+    if rows and has_prev:
+        buttons.append(InlineKeyboardButton("◀️ Trước", callback_data=f"ub|p|{rows[0]['user_id']}|{query}"))
+    if rows and has_next:
+        buttons.append(InlineKeyboardButton("Sau ▶️", callback_data=f"ub|n|{rows[-1]['user_id']}|{query}"))
+    return "\n".join(lines), (InlineKeyboardMarkup([buttons]) if buttons else None)
+
+def _user_query_arg(text: str) -> str:
+    query = normalize_search_name(text)
+    # callback_data is capped at 64 bytes
+    while len(query.encode()) > 32:
+        query = query[:-1]
+    return query
+
+async def users_browser_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/users — duyệt toàn bộ user; /users <tiền tố> — tìm theo username/tên; /users <id>."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Chỉ admin.")
+        return
+    raw = " ".join(context.args or [])
+    if raw.strip().isdigit():
+        u = get_user(int(raw))
+        if not u:
+            await update.message.reply_text("User không tồn tại.")
+            return
+        await update.message.reply_text(
+            f"{u['user_id']} — @{u['username'] or '-'} — {u['first_name'] or '-'}\n"
+            f"Số dư: {int(u['balance'] or 0):,}₫ — Nạp: {int(u['total_deposited'] or 0):,}₫ — "
+            f"Cược: {int(u['total_bet_volume'] or 0):,}₫\nTạo: {u['created_at']}"
+        )
+        return
+    text, kb = render_user_page(_user_query_arg(raw), "n", None)
+    await update.message.reply_text(text, reply_markup=kb)
+
+async def users_browser_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    if q.from_user.id not in ADMIN_IDS:
+        await q.edit_message_text("Chỉ admin mới thao tác.")
+        return
+    parts = (q.data or "").split("|", 3)
+    if len(parts) != 4:
+        await q.edit_message_text("Dữ liệu không hợp lệ.")
+        return
+    _, direction, cursor_s, query = parts
+    try:
+        cursor_uid = int(cursor_s)
+    except ValueError:
+        await q.edit_message_text("Dữ liệu không hợp lệ.")
+        return
+    text, kb = render_user_page(query, direction, cursor_uid)
+    await q.edit_message_text(text, reply_markup=kb)
+
+async def ledger_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/ledger <user_id> [n] — n bút toán gần nhất của user (mặc định 20)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Chỉ admin.")
+        return
+    try:
+        uid = int(context.args[0])
+        n = min(int(context.args[1]), 50) if len(context.args) > 1 else 20
+    except (IndexError, ValueError):
+        await update.message.reply_text("Cú pháp: /ledger <user_id> [n]")
+        return
+    rows = db_query("SELECT id, kind, amount, ref, created_at FROM ledger WHERE user_id=? ORDER BY id DESC LIMIT ?", (uid, n))
+    lines = [f"Số dư {uid}: {int(get_balance(uid)):,}₫", f"{len(rows)} bút toán gần nhất:"]
     for r in rows:
-        text += f"- {r['user_id']}: {int(r['balance'] or 0):,}₫\n"
-    await update.message.reply_text(text)
+        lines.append(f"#{r['id']} {r['created_at'][:19]} {r['kind']} {from_minor(r['amount']):+,.0f}₫ {r['ref'] or ''}")
+    await update.message.reply_text("\n".join(lines)[:4000])
 
 # admin force commands
 async def admin_force_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -648,49 +1587,666 @@ async def redeem_code_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     db_execute("UPDATE promo_codes SET used=1 WHERE code=?", (code,))
     amount = row["amount"]; wager = int(row["wager_required"])
     ensure_user(update.effective_user.id, update.effective_user.username or "", update.effective_user.first_name or "")
-    add_balance(update.effective_user.id, amount)
+    add_balance(update.effective_user.id, amount, "promo", code)
     db_execute("INSERT INTO promo_redemptions(code, user_id, amount, wager_required, wager_progress, last_counted_round, active, redeemed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
                (code, update.effective_user.id, amount, wager, 0, "", 1, now_iso()))
     await update.message.reply_text(f"Bạn nhận {int(amount):,}₫ từ code {code}. Phải cược {wager} vòng để hợp lệ.")
 
-async def update_promo_wager_progress(context: ContextTypes.DEFAULT_TYPE, user_id: int, round_id: str):
-    try:
-        rows = db_query("SELECT id, code, wager_required, wager_progress, last_counted_round, active, amount FROM promo_redemptions WHERE user_id=? AND active=1", (user_id,))
-        if not rows:
-            return
-        for r in rows:
-            rid = r["id"]; last = r["last_counted_round"] or ""
-            if str(last) == str(round_id):
-                continue
-            new_progress = (r["wager_progress"] or 0) + 1
-            active = 1
-            if new_progress >= (r["wager_required"] or 0):
-                active = 0
-            db_execute("UPDATE promo_redemptions SET wager_progress=?, last_counted_round=?, active=? WHERE id=?", (new_progress, str(round_id), active, rid))
-            if active == 0:
-                try:
-                    await context.bot.send_message(chat_id=user_id, text=f"✅ Bạn đã hoàn thành yêu cầu cược cho code {r['code']}! Tiền {int(r['amount']):,}₫ hiện đã hợp lệ.")
-                except Exception:
-                    pass
-    except Exception:
-        logger.exception("update_promo_wager_progress failed")
+def apply_round_wager_progress(chat_id: int, round_id: str, conn=None) -> List[sqlite3.Row]:
+    """Advance wager progress once per settled round for everyone who bet in it, as two
+    set-based UPDATEs in one transaction (the caller's, if conn is given). Must run before the
+    round's bets are archived. Returns the redemptions completed by this round."""
+    if conn is None:
+        with db_transaction() as conn:
+            return apply_round_wager_progress(chat_id, round_id, conn)
+    bettors = "SELECT DISTINCT user_id FROM bets WHERE chat_id=? AND round_id=?"
+    conn.execute(
+        f"UPDATE users SET start_bonus_progress = COALESCE(start_bonus_progress, 0) + 1 "
+        f"WHERE start_bonus_given=1 AND user_id IN ({bettors})",
+        (chat_id, round_id)
+    )
+    conn.execute(
+        f"""
+        UPDATE promo_redemptions SET
+            wager_progress = COALESCE(wager_progress, 0) + 1,
+            last_counted_round = ?,
+            active = CASE WHEN COALESCE(wager_progress, 0) + 1 >= COALESCE(wager_required, 0) THEN 0 ELSE 1 END
+        WHERE active=1 AND COALESCE(last_counted_round, '') != ? AND user_id IN ({bettors})
+        """,
+        (round_id, round_id, chat_id, round_id)
+    )
+    return conn.execute(
+        f"SELECT user_id, code, amount FROM promo_redemptions "
+        f"WHERE active=0 AND last_counted_round=? AND user_id IN ({bettors})",
+        (round_id, chat_id, round_id)
+    ).fetchall()
+
+async def notify_wager_completed(app: Application, completed: List[sqlite3.Row]):
+    async def _send(r):
+        try:
+            await app.bot.send_message(chat_id=r["user_id"], text=f"✅ Bạn đã hoàn thành yêu cầu cược cho code {r['code']}! Tiền {int(r['amount']):,}₫ hiện đã hợp lệ.")
+        except Exception:
+            pass
+    await asyncio.gather(*(_send(r) for r in completed))
 
 # -----------------------
-# Group approval command /batdau & approve callback
+# Settled-bet archive (monthly partitions) + /lichsu
 # -----------------------
-async def batdau_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat = update.effective_chat
-    if chat.type not in ("group","supergroup"):
-        await update.message.reply_text("/batdau chỉ dùng trong nhóm.")
+ARCHIVE_RETENTION_MONTHS = int(os.getenv("ARCHIVE_RETENTION_MONTHS", "0"))  # 0 = keep every partition
+_archive_partitions: set = set()
+
+def archive_partition_name(round_epoch: int) -> str:
+    return "bet_archive_" + datetime.utcfromtimestamp(int(round_epoch) * ROUND_SECONDS).strftime("%Y%m")
+
+def ensure_archive_partition(name: str):
+    # WITHOUT ROWID + PK (user_id, round_epoch, bet_id): the table *is* the per-user index,
+    # so /lichsu is an index-only range scan and never touches the live bets table
+    if name in _archive_partitions:
         return
-    title = chat.title or ""
-    rows = db_query("SELECT chat_id FROM groups WHERE chat_id=?", (chat.id,))
+    conn = get_db_connection()
+    try:
+        conn.executescript(f"""
+        CREATE TABLE IF NOT EXISTS {name} (
+            user_id INTEGER NOT NULL,
+            round_epoch INTEGER NOT NULL,
+            bet_id INTEGER NOT NULL,
+            chat_id INTEGER,
+            side TEXT,
+            amount INTEGER,  -- minor units
+            payout INTEGER,  -- minor units (win payout + pot share), 0 = lost
+            result TEXT,
+            bet_count INTEGER DEFAULT 1,  -- /T /X messages coalesced into this position
+            PRIMARY KEY (user_id, round_epoch, bet_id)
+        ) WITHOUT ROWID;
+        -- covering index for /thongke's "rounds settled since last refresh" range reads
+        CREATE INDEX IF NOT EXISTS {name}_epoch ON {name}(round_epoch, chat_id, user_id, amount, bet_count);
+        """)
+    finally:
+        conn.close()
+    _archive_partitions.add(name)
+
+def list_archive_partitions() -> List[str]:
+    """Newest first."""
+    rows = db_query("SELECT name FROM sqlite_master WHERE type='table' AND name GLOB 'bet_archive_[0-9]*' ORDER BY name DESC")
+    return [r["name"] for r in rows]
+
+def archive_round_bets(chat_id: int, round_id: str, round_epoch: int, result: str, rows: List[Tuple], conn=None):
+    """Move a settled round out of `bets`: insert (user_id, round_epoch, bet_id, chat_id, side,
+    amount, payout, result, bet_count) rows into the month's partition and delete, in one transaction.
+    With conn (an open transaction), the caller must have run ensure_archive_partition first:
+    the partition DDL needs its own connection."""
+    name = archive_partition_name(round_epoch)
+    if conn is None:
+        ensure_archive_partition(name)
+        with db_transaction() as conn:
+            return archive_round_bets(chat_id, round_id, round_epoch, result, rows, conn)
+    if rows:
+        conn.executemany(
+            f"INSERT OR IGNORE INTO {name}(user_id, round_epoch, bet_id, chat_id, side, amount, payout, result, bet_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+    conn.execute("DELETE FROM bets WHERE chat_id=? AND round_id=?", (chat_id, round_id))
+
+def user_bet_history(user_id: int, limit: int) -> List[sqlite3.Row]:
+    out: List[sqlite3.Row] = []
+    for name in list_archive_partitions():
+        out += db_query(
+            f"SELECT round_epoch, chat_id, side, amount, payout, result FROM {name} "
+            f"WHERE user_id=? ORDER BY round_epoch DESC, bet_id DESC LIMIT ?",
+            (user_id, limit - len(out))
+        )
+        if len(out) >= limit:
+            break
+    return out
+
+def prune_bet_archive(keep_months: int) -> List[str]:
+    """Drop whole monthly partitions older than keep_months (cheap, unlike DELETE)."""
+    if keep_months <= 0:
+        return []
+    dropped = []
+    for name in list_archive_partitions()[keep_months:]:
+        db_execute(f"DROP TABLE IF EXISTS {name}")
+        _archive_partitions.discard(name)
+        dropped.append(name)
+    return dropped
+
+async def lichsu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/lichsu [n] — n cược gần nhất đã quyết toán (mặc định 10, tối đa 50)."""
+    try:
+        n = max(1, min(int(context.args[0]), 50)) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("Cú pháp: /lichsu [số lượng]")
+        return
+    rows = user_bet_history(update.effective_user.id, n)
     if not rows:
-        db_execute("INSERT INTO groups(chat_id, title, approved, running, bet_mode, last_round) VALUES (?, ?, 0, 0, 'random', ?)", (chat.id, title, 0))
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("Duyệt", callback_data=f"approve|{chat.id}"),
-         InlineKeyboardButton("Từ chối", callback_data=f"deny|{chat.id}")]
-    ])
+        await update.message.reply_text("Bạn chưa có cược nào đã quyết toán.")
+        return
+    lines = [f"{len(rows)} cược gần nhất:"]
+    for r in rows:
+        side = "TÀI" if r["side"] == "tai" else "XỈU"
+        outcome = f"thắng +{int(from_minor(r['payout'])):,}₫" if r["payout"] else "thua"
+        lines.append(f"Phiên {r['round_epoch']} — {side} {int(from_minor(r['amount'])):,}₫ — KQ {r['result']} — {outcome}")
+    await update.message.reply_text("\n".join(lines))
+
+# -----------------------
+# History retention: daily rollups + compressed cold archive
+# -----------------------
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "30"))  # 0 = keep everything hot
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "history_archive")
+HISTORY_ARCHIVE_CHUNK = int(os.getenv("HISTORY_ARCHIVE_CHUNK", "50000"))  # rows per .jsonl.gz file
+
+def is_triple(dice: str) -> bool:
+    parts = (dice or "").split(",")
+    return len(parts) == 3 and parts[0] == parts[1] == parts[2]
+
+def rollup_and_archive_history(retention_days: int, directory: str, chunk: int) -> int:
+    """Move `history` rows older than retention_days into gzip JSONL chunk files and fold them
+    into history_daily. Each chunk: file written first, then rollup + DELETE in one transaction,
+    so a crash in between only rewrites the same file on the next run. Returns rows archived."""
+    if retention_days <= 0:
+        return 0
+    cutoff_epoch = int(time.time() - retention_days * 86400) // ROUND_SECONDS
+    # never archive past a round still waiting for settle_pending_rounds: it needs its history row
+    pending = db_query("SELECT MIN(round_index) AS r FROM history WHERE settled=0")
+    if pending and pending[0]["r"] is not None:
+        cutoff_epoch = min(cutoff_epoch, int(pending[0]["r"]))
+    os.makedirs(directory, exist_ok=True)
+    archived = 0
+    while True:
+        # history is append-only in time order, so the oldest rows are the lowest ids
+        rows = db_query(
+            "SELECT * FROM history WHERE round_index < ? ORDER BY id LIMIT ?",
+            (cutoff_epoch, chunk)
+        )
+        if not rows:
+            return archived
+        first_id, last_id = rows[0]["id"], rows[-1]["id"]
+        path = os.path.join(directory, f"history_{first_id:012d}_{last_id:012d}.jsonl.gz")
+        tmp = path + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            for r in rows:
+                f.write(json.dumps(dict(r), ensure_ascii=False, separators=(",", ":")) + "\n")
+        os.replace(tmp, path)
+
+        daily: Dict[Tuple[int, str], List[float]] = {}
+        for r in rows:
+            agg = daily.setdefault((r["chat_id"], (r["timestamp"] or "")[:10]), [0, 0, 0, 0, 0.0])
+            agg[0] += 1
+            agg[1] += r["result"] == "tai"
+            agg[2] += r["result"] == "xiu"
+            agg[3] += is_triple(r["dice"])
+            agg[4] += r["volume"] or 0.0
+        with db_transaction() as conn:
+            conn.executemany(
+                """
+                INSERT INTO history_daily(chat_id, day, rounds, tai, xiu, triples, volume) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(chat_id, day) DO UPDATE SET
+                    rounds = rounds + excluded.rounds, tai = tai + excluded.tai, xiu = xiu + excluded.xiu,
+                    triples = triples + excluded.triples, volume = volume + excluded.volume
+                """,
+                [(chat_id, day, *agg) for (chat_id, day), agg in daily.items()]
+            )
+            conn.execute("DELETE FROM history WHERE id BETWEEN ? AND ? AND round_index < ?", (first_id, last_id, cutoff_epoch))
+        archived += len(rows)
+
+def iter_history_archive(directory: str = HISTORY_ARCHIVE_DIR):
+    """Stream archived history rows (oldest first) for audits, one file at a time."""
+    if not os.path.isdir(directory):
+        return
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("history_") and name.endswith(".jsonl.gz")):
+            continue
+        with gzip.open(os.path.join(directory, name), "rt", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+def run_maintenance():
+    dropped = prune_bet_archive(ARCHIVE_RETENTION_MONTHS)
+    if dropped:
+        logger.info(f"Dropped bet archive partitions: {dropped}")
+    archived = rollup_and_archive_history(HISTORY_RETENTION_DAYS, HISTORY_ARCHIVE_DIR, HISTORY_ARCHIVE_CHUNK)
+    if archived:
+        logger.info(f"Archived {archived} history rows to {HISTORY_ARCHIVE_DIR}")
+
+async def maintenance_loop():
+    """Daily housekeeping, run in a worker thread so file/DB work never blocks the loop."""
+    while True:
+        try:
+            await asyncio.to_thread(run_maintenance)
+        except Exception:
+            logger.exception("maintenance_loop failed")
+        await asyncio.sleep(86400)
+
+# -----------------------
+# Streaming export (CSV / JSONL, gzip) — /export and `python bot.py export`
+# -----------------------
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "5000"))
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_MAX_DOCUMENT = 45 * 1024 * 1024  # Bot API upload cap is 50 MB; larger exports stay on disk
+# table -> (keyset columns, time filter column, time column holds round epochs?)
+# Money columns are exported as stored: ledger / bet archive amounts are minor units (÷ MONEY_SCALE).
+EXPORT_TABLES = {
+    "history": (("id",), "timestamp", False),
+    "ledger": (("id",), "created_at", False),
+    "withdrawals": (("id",), "created_at", False),
+    "bets": (("user_id", "round_epoch", "bet_id"), "round_epoch", True),  # every bet_archive_* partition
+}
+
+def export_sources(table: str) -> List[str]:
+    return sorted(list_archive_partitions()) if table == "bets" else [table]
+
+def iter_export_rows(table: str, since: Optional[str] = None, until: Optional[str] = None, chunk: int = EXPORT_CHUNK):
+    """Yield column names, then row tuples, for `table` within [since, until) (YYYY-MM-DD).
+    Keyset-paginated in `chunk`-row reads on a short-lived cursor each, so memory stays flat
+    and no read transaction is held open against the live writers."""
+    key_cols, time_col, epoch_time = EXPORT_TABLES[table]
+    bounds = []
+    for op, day in ((">=", since), ("<", until)):
+        if day:
+            value = int(datetime.fromisoformat(day).replace(tzinfo=timezone.utc).timestamp()) // ROUND_SECONDS if epoch_time else day
+            bounds.append((f"{time_col} {op} ?", value))
+    header_sent = False
+    conn = get_db_connection()
+    try:
+        for source in export_sources(table):
+            cur = conn.execute(f"SELECT * FROM {source} LIMIT 0")
+            if not header_sent:
+                yield [d[0] for d in cur.description]
+                header_sent = True
+            key_sql = ", ".join(key_cols)
+            last_key = None
+            while True:
+                where = [b[0] for b in bounds]
+                params = [b[1] for b in bounds]
+                if last_key is not None:
+                    where.append(f"({key_sql}) > ({', '.join('?' * len(key_cols))})")
+                    params.extend(last_key)
+                sql = f"SELECT * FROM {source}"
+                if where:
+                    sql += " WHERE " + " AND ".join(where)
+                cur = conn.execute(sql + f" ORDER BY {key_sql} LIMIT ?", (*params, chunk))
+                rows = cur.fetchmany(chunk)
+                cur.close()
+                if not rows:
+                    break
+                for r in rows:
+                    yield tuple(r)
+                last_key = tuple(rows[-1][c] for c in key_cols)
+                if len(rows) < chunk:
+                    break
+    finally:
+        conn.close()
+    if not header_sent:
+        yield []
+
+def write_export(fileobj, table: str, fmt: str = "csv", since: Optional[str] = None, until: Optional[str] = None) -> int:
+    """Stream `table` as gzip-compressed CSV or JSONL into a binary file object. Returns rows written."""
+    rows = iter_export_rows(table, since, until)
+    header = next(rows)
+    count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode="wb") as gz:
+        out = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+        if fmt == "csv":
+            writer = csv.writer(out)
+            writer.writerow(header)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                out.write(json.dumps(dict(zip(header, row)), ensure_ascii=False, separators=(",", ":")) + "\n")
+                count += 1
+        out.flush()
+        out.detach()
+    return count
+
+def export_filename(table: str, fmt: str, since: Optional[str], until: Optional[str]) -> str:
+    span = f"{since or 'begin'}_{until or 'now'}"
+    return f"{table}_{span}.{fmt}.gz"
+
+def parse_export_args(args: List[str]):
+    """[table] [csv|jsonl] [since YYYY-MM-DD] [until YYYY-MM-DD]; raises ValueError."""
+    table, fmt, days = None, "csv", []
+    for a in args:
+        if a in EXPORT_TABLES:
+            table = a
+        elif a in ("csv", "jsonl"):
+            fmt = a
+        else:
+            datetime.strptime(a, "%Y-%m-%d")
+            days.append(a)
+    if not table or len(days) > 2:
+        raise ValueError("bad export arguments")
+    since = days[0] if days else None
+    until = days[1] if len(days) > 1 else None
+    return table, fmt, since, until
+
+async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export <history|ledger|withdrawals|bets> [csv|jsonl] [từ YYYY-MM-DD] [đến YYYY-MM-DD]"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Chỉ admin.")
+        return
+    try:
+        table, fmt, since, until = parse_export_args(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            f"Cú pháp: /export <{'|'.join(EXPORT_TABLES)}> [csv|jsonl] [từ YYYY-MM-DD] [đến YYYY-MM-DD]"
+        )
+        return
+    name = export_filename(table, fmt, since, until)
+    tmp = tempfile.TemporaryFile()
+    try:
+        count = await asyncio.to_thread(write_export, tmp, table, fmt, since, until)
+        size = tmp.tell()
+        if size <= EXPORT_MAX_DOCUMENT:
+            tmp.seek(0)
+            await update.message.reply_document(document=tmp, filename=name, caption=f"{table}: {count:,} dòng")
+            return
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        path = os.path.join(EXPORT_DIR, name)
+        tmp.seek(0)
+        with open(path, "wb") as f:
+            await asyncio.to_thread(shutil.copyfileobj, tmp, f)
+        await update.message.reply_text(f"{table}: {count:,} dòng, {size / 1e6:.0f} MB — quá lớn để gửi, đã lưu tại {path}")
+    finally:
+        tmp.close()
+
+def export_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="bot.py export", description="Stream a table to gzip CSV/JSONL without stopping the bot.")
+    parser.add_argument("table", choices=sorted(EXPORT_TABLES))
+    parser.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    parser.add_argument("--since", help="YYYY-MM-DD, inclusive")
+    parser.add_argument("--until", help="YYYY-MM-DD, exclusive")
+    parser.add_argument("-o", "--output", help="output file (default: <table>_<since>_<until>.<format>.gz; '-' = stdout)")
+    args = parser.parse_args(argv)
+    path = args.output or export_filename(args.table, args.format, args.since, args.until)
+    if path == "-":
+        count = write_export(sys.stdout.buffer, args.table, args.format, args.since, args.until)
+    else:
+        with open(path, "wb") as f:
+            count = write_export(f, args.table, args.format, args.since, args.until)
+    print(f"Exported {count} rows from {args.table} to {path}", file=sys.stderr)
+
+# -----------------------
+# Online backups (SQLite incremental backup API -> gzip snapshots)
+# -----------------------
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", str(6 * 3600)))  # seconds; 0 = disabled
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.01"))  # released between steps so writers get the lock
+BACKUP_MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS", "20"))
+BACKUP_RETRY = int(os.getenv("BACKUP_RETRY", "600"))  # seconds before retrying a run skipped under writes
+_backup_lock = threading.Lock()
+
+class BackupBusy(Exception):
+    pass
+
+class _BackupProgress:
+    """Progress callback: a write from another connection makes SQLite restart the copy from
+    page 1 (remaining goes back up); give up after BACKUP_MAX_RESTARTS of those."""
+    def __init__(self):
+        self.last_remaining = None
+        self.restarts = 0
+
+    def __call__(self, status, remaining, total):
+        if self.last_remaining is not None and remaining > self.last_remaining:
+            self.restarts += 1
+            if self.restarts >= BACKUP_MAX_RESTARTS:
+                raise BackupBusy(f"restarted {self.restarts} times under writes")
+        self.last_remaining = remaining
+
+def run_backup(directory: str = BACKUP_DIR, keep: int = BACKUP_KEEP) -> Tuple[str, int]:
+    """Copy DB_FILE page-by-page into a scratch file, gzip it as <db>_<UTC stamp>.db.gz and drop
+    the oldest snapshots beyond `keep`. Runs in a worker thread; the source is only read-locked
+    for BACKUP_PAGES_PER_STEP pages at a time, so bets and settlement keep flowing. Raises
+    BackupBusy if writes keep restarting the copy; the run is dropped, never finished under a
+    lock that would stall the writers. Returns (path, compressed size)."""
+    with _backup_lock:
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.splitext(os.path.basename(DB_FILE))[0]
+        path = os.path.join(directory, f"{base}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.db.gz")
+        scratch = path[:-len(".gz")] + ".tmp"
+        src = sqlite3.connect(DB_FILE, check_same_thread=False)
+        dst = sqlite3.connect(scratch)
+        try:
+            try:
+                src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=_BackupProgress(), sleep=BACKUP_STEP_SLEEP)
+            finally:
+                dst.close()
+                src.close()
+            with open(scratch, "rb") as f_in, gzip.open(path + ".tmp", "wb", compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(path + ".tmp", path)
+        finally:
+            for leftover in (scratch, path + ".tmp"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        snapshots = sorted(n for n in os.listdir(directory) if n.startswith(base + "_") and n.endswith(".db.gz"))
+        for old in snapshots[:-keep] if keep > 0 else []:
+            os.remove(os.path.join(directory, old))
+        return path, os.path.getsize(path)
+
+async def backup_loop():
+    if BACKUP_INTERVAL <= 0:
+        return
+    delay = BACKUP_INTERVAL
+    while True:
+        await asyncio.sleep(delay)
+        delay = BACKUP_INTERVAL
+        try:
+            path, size = await asyncio.to_thread(run_backup)
+            logger.info(f"Backup written: {path} ({size / 1e6:.1f} MB)")
+        except BackupBusy as e:
+            delay = min(BACKUP_RETRY, BACKUP_INTERVAL)
+            logger.warning(f"Backup skipped ({e}), retrying in {delay}s")
+        except Exception:
+            logger.exception("backup_loop failed")
+
+async def backup_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/backup — tạo bản sao lưu ngay (không dừng bot)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Chỉ admin.")
+        return
+    await update.message.reply_text("⏳ Đang sao lưu...")
+    try:
+        path, size = await asyncio.to_thread(run_backup)
+    except BackupBusy:
+        await update.message.reply_text("⚠️ DB đang ghi liên tục, bỏ qua lần sao lưu này — thử lại sau.")
+        return
+    except Exception as e:
+        logger.exception("backup failed")
+        await update.message.reply_text(f"❌ Sao lưu lỗi: {e}")
+        return
+    await update.message.reply_text(f"✅ Đã sao lưu: {path} ({size / 1e6:.1f} MB)")
+
+# -----------------------
+# Round statistics (/thongke): columnar NumPy aggregates, cached incrementally
+# -----------------------
+STATS_CHUNK = int(os.getenv("STATS_CHUNK", "50000"))
+RESULT_CODES = {"xiu": 0, "tai": 1}  # anything else (invalid / triple) = 2
+_stats_lock = threading.Lock()
+# history_id: last history row folded in; epoch_hwm: bet archive rounds <= this are folded in
+_stats: Dict[str, Any] = {"seeded": False, "history_id": 0, "epoch_hwm": 0, "chats": {}}
+
+def _chat_stats(chat_id: int) -> Dict[str, Any]:
+    chats = _stats["chats"]
+    if chat_id not in chats:
+        chats[chat_id] = {
+            "rounds": 0, "tai": 0, "xiu": 0, "triples": 0,
+            "max_tai": 0, "max_xiu": 0, "last_result": -1, "run": 0,
+            "bets": 0, "volume": 0, "hours": np.zeros(24, dtype=np.int64),  # volume in minor units
+            "bettors": np.empty(0, dtype=np.int64),  # sorted unique user ids
+        }
+    return chats[chat_id]
+
+def iter_columns(conn, sql: str, params: Tuple, dtypes: Tuple, chunk: int = STATS_CHUNK):
+    """Run `sql` and yield one tuple of NumPy column arrays per `chunk` rows."""
+    cur = conn.execute(sql, params)
+    try:
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                return
+            yield tuple(np.fromiter((r[i] for r in rows), dtype=dt, count=len(rows)) for i, dt in enumerate(dtypes))
+    finally:
+        cur.close()
+
+def _fold_history(chat: np.ndarray, result: np.ndarray, triple: np.ndarray):
+    """Add a chunk of history rows (id order) to the per-chat counters and streaks."""
+    chats, inv = np.unique(chat, return_inverse=True)
+    rounds = np.bincount(inv, minlength=len(chats))
+    tai = np.bincount(inv, weights=result == 1, minlength=len(chats))
+    xiu = np.bincount(inv, weights=result == 0, minlength=len(chats))
+    triples = np.bincount(inv, weights=triple, minlength=len(chats))
+
+    # runs of equal results per chat: stable-sort by chat keeps id order inside each chat
+    order = np.argsort(inv, kind="stable")
+    g, r = inv[order], result[order]
+    starts = np.flatnonzero(np.r_[True, (g[1:] != g[:-1]) | (r[1:] != r[:-1])])
+    run_len = np.diff(np.r_[starts, len(g)])
+    run_chat, run_res = g[starts], r[starts]
+    first_of_chat = np.r_[True, run_chat[1:] != run_chat[:-1]]
+    last_of_chat = np.r_[run_chat[1:] != run_chat[:-1], True]
+    # a chat's first run continues the streak carried over from the previous chunk
+    carry_res = np.array([_chat_stats(int(c))["last_result"] for c in chats])
+    carry_run = np.array([_chat_stats(int(c))["run"] for c in chats])
+    cont = first_of_chat & (run_res == carry_res[run_chat])
+    run_len = run_len + np.where(cont, carry_run[run_chat], 0)
+    max_tai = np.zeros(len(chats), dtype=np.int64)
+    max_xiu = np.zeros(len(chats), dtype=np.int64)
+    np.maximum.at(max_tai, run_chat, np.where(run_res == 1, run_len, 0))
+    np.maximum.at(max_xiu, run_chat, np.where(run_res == 0, run_len, 0))
+
+    for i, c in enumerate(chats):
+        s = _chat_stats(int(c))
+        s["rounds"] += int(rounds[i])
+        s["tai"] += int(tai[i])
+        s["xiu"] += int(xiu[i])
+        s["triples"] += int(triples[i])
+        s["max_tai"] = max(s["max_tai"], int(max_tai[i]))
+        s["max_xiu"] = max(s["max_xiu"], int(max_xiu[i]))
+    lasts = np.flatnonzero(last_of_chat)
+    for j in lasts:
+        s = _chat_stats(int(chats[run_chat[j]]))
+        s["last_result"], s["run"] = int(run_res[j]), int(run_len[j])
+
+def _fold_bets(chat: np.ndarray, epoch: np.ndarray, user: np.ndarray, amount: np.ndarray, count: np.ndarray):
+    chats, inv = np.unique(chat, return_inverse=True)
+    bets = np.bincount(inv, weights=count, minlength=len(chats))
+    volume = np.bincount(inv, weights=amount, minlength=len(chats))
+    hour = (epoch * ROUND_SECONDS // 3600) % 24
+    hours = np.zeros((len(chats), 24), dtype=np.int64)
+    np.add.at(hours, (inv, hour), amount)
+    for i, c in enumerate(chats):
+        s = _chat_stats(int(c))
+        s["bets"] += int(bets[i])
+        s["volume"] += int(volume[i])
+        s["hours"] += hours[i]
+        s["bettors"] = np.union1d(s["bettors"], user[inv == i])
+
+def refresh_stats() -> Dict[int, Dict[str, Any]]:
+    """Fold history rows and settled archive rounds added since the last call into the cache.
+    Cold start seeds counters from history_daily (rows already rolled out of `history`);
+    streaks and per-hour volume only cover what is still loadable."""
+    with _stats_lock:
+        conn = get_db_connection()
+        try:
+            if not _stats["seeded"]:
+                for r in conn.execute("SELECT chat_id, SUM(rounds), SUM(tai), SUM(xiu), SUM(triples) FROM history_daily GROUP BY chat_id"):
+                    s = _chat_stats(r[0])
+                    s["rounds"], s["tai"], s["xiu"], s["triples"] = r[1], r[2], r[3], r[4]
+                _stats["seeded"] = True
+
+            for chat, result, triple, ids in iter_columns(
+                conn,
+                """
+                SELECT chat_id,
+                       CASE result WHEN 'xiu' THEN 0 WHEN 'tai' THEN 1 ELSE 2 END,
+                       substr(dice, 1, 1) = substr(dice, 3, 1) AND substr(dice, 3, 1) = substr(dice, 5, 1),
+                       id
+                FROM history WHERE id > ? ORDER BY id
+                """,
+                (_stats["history_id"],), (np.int64, np.int8, np.bool_, np.int64)
+            ):
+                _fold_history(chat, result, triple)
+                _stats["history_id"] = int(ids[-1])
+
+            # a round is settled at the start of the next epoch, so every round up to two epochs
+            # back is archived -- except ones waiting for settle_pending_rounds
+            hwm = int(time.time()) // ROUND_SECONDS - 2
+            pending = conn.execute("SELECT MIN(round_index) FROM history WHERE settled=0").fetchone()[0]
+            if pending is not None:
+                hwm = min(hwm, int(pending) - 1)
+            lo = _stats["epoch_hwm"]
+            if hwm > lo:
+                for name in sorted(list_archive_partitions()):
+                    if lo and name < archive_partition_name(lo):
+                        continue  # whole month already folded in
+                    for cols in iter_columns(
+                        conn,
+                        f"SELECT chat_id, round_epoch, user_id, amount, bet_count FROM {name} WHERE round_epoch > ? AND round_epoch <= ?",
+                        (lo, hwm), (np.int64, np.int64, np.int64, np.int64, np.int64)
+                    ):
+                        _fold_bets(*cols)
+                _stats["epoch_hwm"] = hwm
+        finally:
+            conn.close()
+        return copy.deepcopy(_stats["chats"])
+
+def format_stats(chats: Dict[int, Dict[str, Any]], chat_id: Optional[int] = None) -> str:
+    if chat_id is not None:
+        chats = {chat_id: chats[chat_id]} if chat_id in chats else {}
+    if not chats:
+        return "Chưa có dữ liệu thống kê."
+    lines = ["📊 Thống kê"]
+    for cid, s in sorted(chats.items(), key=lambda kv: -kv[1]["volume"]):
+        rounds = max(s["rounds"], 1)
+        decided = max(s["tai"] + s["xiu"], 1)
+        lines.append(
+            f"\nNhóm {cid}: {s['rounds']:,} phiên — Tài {s['tai'] / decided:.1%} / Xỉu {s['xiu'] / decided:.1%}, "
+            f"bộ ba {s['triples'] / rounds:.2%}\n"
+            f"Chuỗi dài nhất: Tài {s['max_tai']}, Xỉu {s['max_xiu']}\n"
+            f"Cược: {s['bets']:,} lượt, {from_minor(s['volume']):,.0f}₫, {len(s['bettors']):,} người chơi"
+        )
+        if chat_id is not None and s["volume"]:
+            top = np.argsort(s["hours"])[::-1][:3]
+            lines.append("Giờ sôi động (UTC): " + ", ".join(f"{h:02d}h {from_minor(int(s['hours'][h])):,.0f}₫" for h in top if s["hours"][h]))
+    return "\n".join(lines)[:4000]
+
+async def thongke_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/thongke [chat_id] — thống kê theo nhóm (trong nhóm: mặc định nhóm hiện tại)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Chỉ admin.")
+        return
+    chat_id = None
+    if context.args:
+        try:
+            chat_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Cú pháp: /thongke [chat_id]")
+            return
+    elif update.effective_chat.type != "private":
+        chat_id = update.effective_chat.id
+    chats = await asyncio.to_thread(refresh_stats)
+    await update.message.reply_text(format_stats(chats, chat_id))
+
+# -----------------------
+# Group approval command /batdau & approve callback
+# -----------------------
+async def batdau_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if chat.type not in ("group","supergroup"):
+        await update.message.reply_text("/batdau chỉ dùng trong nhóm.")
+        return
+    title = chat.title or ""
+    rows = db_query("SELECT chat_id FROM groups WHERE chat_id=?", (chat.id,))
+    if not rows:
+        db_execute("INSERT INTO groups(chat_id, title, approved, running, bet_mode, last_round) VALUES (?, ?, 0, 0, 'random', ?)", (chat.id, title, 0))
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("Duyệt", callback_data=f"approve|{chat.id}"),
+         InlineKeyboardButton("Từ chối", callback_data=f"deny|{chat.id}")]
+    ])
     text = f"Yêu cầu bật bot cho nhóm:\n{title}\nchat_id: {chat.id}\nNgười yêu cầu: {update.effective_user.id}"
     for aid in ADMIN_IDS:
         try:
@@ -741,465 +2297,124 @@ def format_history_line(chat_id: int) -> str:
         mapped.append(BLACK if r == "tai" else WHITE)
     return " ".join(mapped)
 
-async def run_round_for_group(app: Application, chat_id: int):
-    """
-    Xử lý 1 phiên cho nhóm:
-    - xác định round_id
-    - gom cược
-    - (nếu có) áp dụng chế độ ép kết quả / cầu bệt
-    - hiển thị GIF quay (nếu có) và gửi từng xúc xắc cách đều
-    - tính kết quả, lưu history
-    - trả thưởng cho người thắng, đưa tiền thua + house_share vào pot
-    - xử lý special triple -> chia pot
-    - gửi thông báo kết quả tới group và summary cho admin
-    """
-    try:
-        # --- chuẩn bị phiên ---
-        now_ts = int(datetime.utcnow().timestamp())
-        round_epoch = now_ts // ROUND_SECONDS
-        round_index = round_epoch
-        round_id = f"{chat_id}_{round_epoch}"
-
-        # Lấy cược của phiên (nếu có)
-        bets_rows = db_query("SELECT user_id, side, amount FROM bets WHERE chat_id=? AND round_id=?", (chat_id, round_id))
-        bets = [dict(r) for r in bets_rows] if bets_rows else []
-
-        # Lấy chế độ nhóm
-        grows = db_query("SELECT bet_mode FROM groups WHERE chat_id=?", (chat_id,))
-        bet_mode = grows[0]["bet_mode"] if grows else "random"
-
-        # Quyết định forced/bettai/betxiu
-        forced_value = None
-        if bet_mode == "force_tai":
-            forced_value = "tai"
-            # revert one-shot
-            db_execute("UPDATE groups SET bet_mode='random' WHERE chat_id=?", (chat_id,))
-        elif bet_mode == "force_xiu":
-            forced_value = "xiu"
-            db_execute("UPDATE groups SET bet_mode='random' WHERE chat_id=?", (chat_id,))
-        elif bet_mode == "bettai":
-            forced_value = "tai"
-        elif bet_mode == "betxiu":
-            forced_value = "xiu"
-
-        # Thông báo bắt đầu tung xúc xắc
-        try:
-            await app.bot.send_message(chat_id=chat_id, text=f"🎲 Phiên {round_index} — Đang tung xúc xắc...")
-        except Exception:
-            # không quan trọng nếu gửi thất bại
-            pass
-
-        # --- Quay xúc xắc ---
-        dice = []
-        special = None
-        total = 0
-
-        # Nếu có GIF spin, gửi GIF 3D quay (nếu định nghĩa DICE_SPIN_GIF_URL)
-        if 'DICE_SPIN_GIF_URL' in globals() and DICE_SPIN_GIF_URL:
-            try:
-                await app.bot.send_animation(chat_id=chat_id, animation=DICE_SPIN_GIF_URL, caption="🔄 Quay xúc xắc...")
-                # chờ GIF quay (điều chỉnh thời gian nếu cần)
-                await asyncio.sleep(1.2)
-            except Exception:
-                pass
-
-        if forced_value:
-            # tìm 1 bộ xúc xắc phù hợp với forced_value (giới hạn số lần thử để tránh loop)
-            attempts = 0
-            dice, total, special = roll_three_dice_random()
-            while result_from_total(total) != forced_value and attempts < 200:
-                dice, total, special = roll_three_dice_random()
-                attempts += 1
-            # gửi từng viên ra cho đẹp
-            for val in dice:
-                try:
-                    await app.bot.send_message(chat_id=chat_id, text=f"{DICE_CHARS[val-1]}")
-                except Exception:
-                    pass
-                await asyncio.sleep(1.0)
-        else:
-            # bình thường: tung từng viên và gửi từng viên 1s-1.2s
-            a = roll_one_die()
-            dice.append(a)
-            try:
-                await app.bot.send_message(chat_id=chat_id, text=f"{DICE_CHARS[a-1]}")
-            except Exception:
-                pass
-            await asyncio.sleep(1.2)
-
-            b = roll_one_die()
-            dice.append(b)
-            try:
-                await app.bot.send_message(chat_id=chat_id, text=f"{DICE_CHARS[b-1]}")
-            except Exception:
-                pass
-            await asyncio.sleep(1.2)
-
-            c = roll_one_die()
-            dice.append(c)
-            try:
-                await app.bot.send_message(chat_id=chat_id, text=f"{DICE_CHARS[c-1]}")
-            except Exception:
-                pass
-
-            total = sum(dice)
-            if dice.count(1) == 3:
-                special = "triple1"
-            elif dice.count(6) == 3:
-                special = "triple6"
-
-        # đảm bảo total được set cho trường hợp forced
-        if total == 0:
-            total = sum(dice)
-
-        # Kết quả cuối cùng
-        result = result_from_total(total)
-
-        # --- Lưu lịch sử ---
-        dice_str = ",".join(map(str, dice))
-        try:
-            db_execute(
-                "INSERT INTO history(chat_id, round_index, round_id, result, dice, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-                (chat_id, round_index, round_id, result, dice_str, now_iso())
-            )
-        except Exception:
-            logger.exception("Failed to insert history")
-
-        # --- Tính winners / losers ---
-        winners = []
-        losers = []
-        total_winner_bets = 0.0
-        total_loser_bets = 0.0
-
-        for b in bets:
-            side = b.get("side")
-            amt = float(b.get("amount") or 0.0)
-            if side == result:
-                winners.append((b["user_id"], amt))
-                total_winner_bets += amt
-            else:
-                losers.append((b["user_id"], amt))
-                total_loser_bets += amt
-
-        # --- Chuyển tiền thua vào pot (atomic) ---
-        try:
-            if total_loser_bets > 0:
-                db_execute("UPDATE pot SET amount = amount + ? WHERE id = 1", (total_loser_bets,))
-        except Exception:
-            logger.exception("Failed to add losers to pot")
-
-        # -------- TRẢ THƯỞNG --------
-        winners_paid = []
-        for uid, amt in winners:
-            try:
-                house_share = amt * HOUSE_RATE
-                payout = amt * WIN_MULTIPLIER
-
-                # cộng house share vào pot
-                if house_share > 0:
-                    try:
-                        db_execute("UPDATE pot SET amount = amount + ? WHERE id = 1", (house_share,))
-                    except Exception:
-                        logger.exception("Failed to add house share to pot")
-
-                # đảm bảo user tồn tại
-                ensure_user(uid, "", "")
-
-                # cộng tiền thưởng
-                try:
-                    db_execute(
-                        """
-                        UPDATE users SET
-                            balance = COALESCE(balance, 0) + ?,
-                            current_streak = COALESCE(current_streak, 0) + 1,
-                            best_streak = CASE
-                                COALESCE(current_streak, 0) + 1 > COALESCE(best_streak, 0)
-                                THEN COALESCE(current_streak, 0) + 1
-                                ELSE COALESCE(best_streak, 0)
-                            END
-                        WHERE user_id = ?
-                        """,
-                        (payout, uid)
-                    )
-                except Exception:
-                    u = get_user(uid) or {"balance": 0, "current_streak": 0, "best_streak": 0}
-                    new_balance = (u.get("balance") or 0) + payout
-                    new_cur = (u.get("current_streak") or 0) + 1
-                    new_best = max(u.get("best_streak") or 0, new_cur)
-                    db_execute(
-                        "UPDATE users SET balance=?, current_streak=?, best_streak=? WHERE user_id=?",
-                        (new_balance, new_cur, new_best, uid)
-                    )
-
-                winners_paid.append((uid, payout, amt))
-            except Exception:
-                logger.exception(f"Error paying winner {uid}")
-                # thông báo admin nếu muốn
-                for aid in ADMIN_IDS:
-                    try:
-                        await app.bot.send_message(chat_id=aid, text=f"ERROR paying winner {uid} in group {chat_id}")
-                    except Exception:
-                        pass
-
-        # --- Reset streak losers ---
-        for uid, amt in losers:
-            try:
-                db_execute("UPDATE users SET current_streak=0 WHERE user_id=?", (uid,))
-            except Exception:
-                logger.exception(f"Failed to reset streak for user {uid}")
-
-        # --- Special triple handling: chia pot cho winners tỉ lệ cược ---
-        special_msg = ""
-        try:
-            if special in ("triple1", "triple6"):
-                pot_amount = get_pot_amount()
-                if pot_amount > 0 and winners:
-                    total_bets_win = sum([amt for (_, amt) in winners]) or 0.0
-                    if total_bets_win > 0:
-                        for uid, amt in winners:
-                            share = (amt / total_bets_win) * pot_amount
-                            ensure_user(uid, "", "")
-                            u = get_user(uid)
-                            db_execute("UPDATE users SET balance = COALESCE(balance,0) + ? WHERE user_id=?", (share, uid))
-                        special_msg = f"Hũ {int(pot_amount):,}₫ đã được chia cho người thắng theo tỷ lệ cược!"
-                        reset_pot()
-        except Exception:
-            logger.exception("Error handling special triple")
-
-        # --- Xóa cược cho phiên này (sau khi đã trả) ---
-        try:
-            db_execute("DELETE FROM bets WHERE chat_id=? AND round_id=?", (chat_id, round_id))
-        except Exception:
-            logger.exception("Failed to delete bets for round after settlement")
-
-        # --- Chuẩn bị tin nhắn gửi nhóm ---
-        display = "Tài" if result == "tai" else "Xỉu"
-        symbol = BLACK if result == "tai" else WHITE
-        history_line = format_history_line(chat_id)
-
-        msg = f"▶️ Phiên {round_index} — Kết quả: {display} {symbol}\n"
-        msg += f"Xúc xắc: {' '.join([DICE_CHARS[d-1] for d in dice])} — Tổng: {total}\n"
-        if special_msg:
-            msg += f"\n{special_msg}\n"
-        if history_line:
-            msg += f"\nLịch sử ({MAX_HISTORY} gần nhất):\n{history_line}\n"
-
-        try:
-            await app.bot.send_message(chat_id=chat_id, text=msg)
-        except Exception:
-            logger.exception("Cannot send round result to group")
-
-        # --- Gửi tóm tắt cho admin (nếu cần) ---
-        if winners_paid:
-            admin_summary = f"Round {round_index} in group {chat_id} completed.\nResult: {result}\nWinners:\n"
-            for uid, payout, amt in winners_paid:
-                admin_summary += f"- {uid}: đặt {int(amt):,} -> nhận {int(payout):,}\n"
-            for aid in ADMIN_IDS:
-                try:
-                    await app.bot.send_message(chat_id=aid, text=admin_summary)
-                except Exception:
-                    logger.exception(f"Không gửi được admin summary cho admin {aid}")
-
-    except Exception as e:
-        logger.exception("Exception in run_round_for_group")
-        # notify admins about fatal exception for this group
-        for aid in ADMIN_IDS:
-            try:
-                await app.bot.send_message(chat_id=aid, text=f"ERROR - run_round_for_group exception for group {chat_id}: {e}\n{traceback.format_exc()}")
-            except Exception:
-                pass
-             
-async def run_round_for_group(app, chat_id, round_epoch):
-    try:
-        # ----- Xử lý xúc xắc + kết quả -----
-        dice = roll_dice(3)
-        total = sum(dice)
-        result = "tai" if total >= 11 else "xiu"  # hoặc tùy luật bạn dùng
-        round_id = round_epoch
-
-        # ----- Lấy danh sách cược -----
-        bets = db_query("SELECT * FROM bets WHERE chat_id=? AND round_id=?", (chat_id, round_id))
-
-        winners = []
-        losers = []
-
-        for b in bets:
-            uid = b["user_id"]
-            amt = float(b["amount"] or 0.0)
-            if b["side"] == result:
-                winners.append((uid, amt))
-            else:
-                losers.append((uid, amt))
-
-        # ----- Cộng tiền cho winners -----
-        for uid, amt in winners:
-            payout = amt * 2  # thắng ăn gấp đôi, bạn có thể chỉnh nếu cần
-            try:
-                db_execute("UPDATE users SET balance = balance + ? WHERE user_id=?", (payout, uid))
-            except Exception:
-                logger.exception(f"Failed to pay winner {uid}")
-
-        # ----- Reset streak cho losers -----
-        for uid, amt in losers:
-            try:
-                db_execute("UPDATE users SET current_streak=0 WHERE user_id=?", (uid,))
-            except Exception:
-                logger.exception(f"Failed to reset streak for user {uid}")
-
-        # ----- Gửi kết quả vòng -----
-        display = "Tài" if result == "tai" else "Xỉu"
-        symbol = BLACK if result == "tai" else WHITE
-        msg = f"▶️ Phiên {round_id} — Kết quả: {display} {symbol}\n"
-        msg += f"Xúc xắc: {' '.join([DICE_CHARS[d-1] for d in dice])} — Tổng: {total}\n"
-        await app.bot.send_message(chat_id=chat_id, text=msg)
-
-        # ----- Gửi admin summary -----
-        if winners:
-            admin_summary = f"Round {round_id} | Group {chat_id}\nResult: {result}\nWinners:\n"
-            for uid, amt in winners:
-                admin_summary += f"- {uid}: đặt {int(amt):,} → nhận {int(amt*2):,}\n"
-            for aid in ADMIN_IDS:
-                try:
-                    await app.bot.send_message(chat_id=aid, text=admin_summary)
-                except:
-                    pass
-
-    except Exception as e:
-        logger.exception(f"Exception in run_round_for_group: {e}")
-        # --- logic xử lý vòng chơi ---
-        # (tính result, winners, losers, settle tiền, v.v...)
-
-        # 🟡 Gửi kết quả cho group
-        display = "Tài" if result == "tai" else "Xỉu"
-        symbol = BLACK if result == "tai" else WHITE
-        history_line = format_history_line(chat_id)
-        msg = f"▶️ Phiên {round_index} — Kết quả: {display} {symbol}\n"
-        msg += f"Xúc xắc: {' '.join([DICE_CHARS[d-1] for d in dice])} — Tổng: {total}\n"
-        if special_msg:
-            msg += f"\n{special_msg}\n"
-        if history_line:
-            msg += f"\nLịch sử ({MAX_HISTORY} gần nhất):\n{history_line}\n"
-        try:
-            await app.bot.send_message(chat_id=chat_id, text=msg)
-        except:
-            logger.exception("Cannot send round result to group")
-
-        # 🟢 Gửi tóm tắt cho admin
-        if winners_paid:
-            admin_summary = f"Round {round_index} in group {chat_id} completed.\nResult: {result}\nWinners:\n"
-            for uid, payout, amt in winners_paid:
-                admin_summary += f"- {uid}: đặt {int(amt):,} -> nhận {int(payout):,}\n"
-            for aid in ADMIN_IDS:
-                try:
-                    await app.bot.send_message(chat_id=aid, text=admin_summary)
-                except:
-                    pass
-
-    except Exception as e:
-        logger.exception(f"Exception in run_round_for_group: {e}")
-
-        # unlock group
-        try:
-            await unlock_group_chat(app.bot, chat_id)
-        except:
-            pass
-
-    except Exception as e:
-        logger.exception("Exception in run_round_for_group")
-        for aid in ADMIN_IDS:
-            try:
-                await app.bot.send_message(
-                    chat_id=aid,
-                    text=f"ERROR - run_round_for_group exception for group {chat_id}: {e}\n{traceback.format_exc()}"
-                )
-            except:
-                pass
-
-# rounds orchestrator: waits for epoch boundaries and coordinates countdowns
-async def rounds_loop(app: Application):
-    logger.info("Rounds orchestrator started")
-    await asyncio.sleep(2)
-    while True:
-        try:
-            now_ts = int(datetime.utcnow().timestamp())
-            next_epoch_ts = ((now_ts // ROUND_SECONDS) + 1) * ROUND_SECONDS
-            rem = next_epoch_ts - now_ts
-
-            if rem > 30:
-                await asyncio.sleep(rem - 30)
-                rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
-                for r in rows:
-                    asyncio.create_task(send_countdown(app.bot, r["chat_id"], 30))
-                await asyncio.sleep(20)
-                rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
-                for r in rows:
-                    asyncio.create_task(send_countdown(app.bot, r["chat_id"], 10))
-                await asyncio.sleep(5)
-                rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
-                for r in rows:
-                    asyncio.create_task(send_countdown(app.bot, r["chat_id"], 5))
-                await asyncio.sleep(5)
-            else:
-                # if less than 30s remain, send appropriate countdowns
-                if rem > 10:
-                    await asyncio.sleep(rem - 10)
-                    rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
-                    for r in rows:
-                        asyncio.create_task(send_countdown(app.bot, r["chat_id"], 10))
-                    await asyncio.sleep(5)
-                    rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
-                    for r in rows:
-                        asyncio.create_task(send_countdown(app.bot, r["chat_id"], 5))
-                    await asyncio.sleep(5)
-                elif rem > 5:
-                    await asyncio.sleep(rem - 5)
-                    rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
-                    for r in rows:
-                        asyncio.create_task(send_countdown(app.bot, r["chat_id"], 5))
-                    await asyncio.sleep(5)
-                else:
-                    # rem <=5
-                    rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
-                    for r in rows:
-                        asyncio.create_task(send_countdown(app.bot, r["chat_id"], 5))
-                    await asyncio.sleep(rem)
-
-            # run rounds at boundary
-            round_epoch = int(datetime.utcnow().timestamp()) // ROUND_SECONDS
-            rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
-            tasks = []
-            for r in rows:
-                tasks.append(asyncio.create_task(run_round_for_group(app, r["chat_id"], round_epoch)))
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
-
-        except Exception:
-            logger.exception("Exception in rounds_loop")
-            for aid in ADMIN_IDS:
-                try:
-                    await app.bot.send_message(chat_id=aid, text=f"ERROR - rounds_loop exception:\n{traceback.format_exc()}")
-                except:
-                    pass
-
-# -----------------------
-# Startup / Shutdown + Main entrypoint (PTB v20+ chuẩn)
-# -----------------------
-import traceback
-import asyncio
-import random
+def settle_round(chat_id: int, round_id: str, round_index: int, result: str,
+                 special: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Settle one round in a single transaction: pot contribution, payouts + streaks, triple pot
+    split, wager progress and the bets -> archive move commit together or not at all. The bets
+    are read inside the BEGIN IMMEDIATE, so a bet that lands while the dice roll is settled with
+    the rest instead of being deleted unpaid. The history.settled flag is claimed in the same
+    transaction (ledger refs are the round_id), so retrying a round never pays it twice.
+    Returns None if the round was already settled."""
+    ensure_archive_partition(archive_partition_name(round_index))
+    bets: List[sqlite3.Row] = []
+    try:
+        with db_transaction() as conn:
+            claimed = conn.execute(
+                "UPDATE history SET settled=1 WHERE chat_id=? AND round_id=? AND settled=0", (chat_id, round_id)
+            ).rowcount
+            if not claimed:
+                return None
+            # one row per (user, side) position, however many /T /X messages it took
+            bets = conn.execute(
+                "SELECT id, user_id, side, amount, bet_count FROM bets WHERE chat_id=? AND round_id=?", (chat_id, round_id)
+            ).fetchall()
+            winners: List[Tuple[int, float]] = []
+            losers: List[Tuple[int, float]] = []
+            for b in bets:
+                amt = float(b["amount"] or 0.0)
+                (winners if b["side"] == result else losers).append((int(b["user_id"]), amt))
+            total_bets_win = sum(amt for _, amt in winners)
+            conn.execute(
+                "UPDATE history SET volume=? WHERE chat_id=? AND round_id=?",
+                (total_bets_win + sum(amt for _, amt in losers), chat_id, round_id)
+            )
+            # Pot: tiền thua + house share của cả phiên -> 1 delta vào shard của nhóm
+            pot_delta = sum(amt for _, amt in losers) + total_bets_win * HOUSE_RATE
+            if pot_delta > 0:
+                add_to_pot(pot_delta, chat_id, conn)
+            payouts = [(uid, amt * WIN_MULTIPLIER, amt) for uid, amt in winners]
+            if payouts:
+                post_ledger(conn, [(uid, "payout", payout, round_id) for uid, payout, _ in payouts])
+                conn.executemany(
+                    """
+                    UPDATE users SET
+                        current_streak = COALESCE(current_streak, 0) + 1,
+                        best_streak = CASE
+                            WHEN COALESCE(current_streak, 0) + 1 > COALESCE(best_streak, 0)
+                            THEN COALESCE(current_streak, 0) + 1
+                            ELSE COALESCE(best_streak, 0)
+                        END
+                    WHERE user_id = ?
+                    """,
+                    [(uid,) for uid in dict.fromkeys(uid for uid, _ in winners)]
+                )
+            if losers:
+                conn.executemany("UPDATE users SET current_streak=0 WHERE user_id=?", [(uid,) for uid in dict.fromkeys(uid for uid, _ in losers)])
+            # Special triple: chia hũ (đã gồm delta phiên này) cho winners theo tỉ lệ cược
+            pot_paid = 0.0
+            if special in ("triple1", "triple6") and total_bets_win > 0:
+                pot_amount = get_pot_amount(conn)
+                if pot_amount > 0:
+                    post_ledger(conn, [(uid, "pot", (amt / total_bets_win) * pot_amount, round_id) for uid, amt in winners])
+                    reset_pot(conn)
+                    pot_paid = pot_amount
+            completed = apply_round_wager_progress(chat_id, round_id, conn)
+            archive_rows = []
+            for b in bets:
+                amt = float(b["amount"] or 0.0)
+                payout = 0.0
+                if b["side"] == result:
+                    payout = amt * WIN_MULTIPLIER
+                    if pot_paid:
+                        payout += (amt / total_bets_win) * pot_paid
+                archive_rows.append((b["user_id"], round_index, b["id"], chat_id, b["side"], to_minor(amt), to_minor(payout), result, b["bet_count"] or 1))
+            archive_round_bets(chat_id, round_id, round_index, result, archive_rows, conn)
+    finally:
+        invalidate_users({int(b["user_id"]) for b in bets})
+    return {
+        "bets": len(bets),
+        "winners_paid": payouts,
+        "completed": completed,
+        "special_msg": f"Hũ {int(pot_paid):,}₫ đã được chia cho người thắng theo tỷ lệ cược!" if pot_paid else "",
+    }
+
+async def settle_pending_rounds(app, before_epoch: int):
+    """Retry rounds whose settlement failed (history.settled=0) with their recorded result."""
+    rows = db_query(
+        "SELECT chat_id, round_index, round_id, result, dice FROM history WHERE settled=0 AND round_index < ? ORDER BY round_index",
+        (before_epoch,)
+    )
+    for r in rows:
+        chat_id, round_id = r["chat_id"], r["round_id"]
+        special = None
+        if is_triple(r["dice"]):
+            special = {"1": "triple1", "6": "triple6"}.get(r["dice"].split(",")[0])
+        try:
+            settlement = settle_round(chat_id, round_id, int(r["round_index"]), r["result"], special)
+        except Exception:
+            logger.exception(f"Retry of settlement {round_id} failed")
+            report_exception(f"settlement retry group {chat_id}")
+            continue
+        if settlement is None:
+            continue
+        logger.info(f"Settled pending round {round_id} ({settlement['bets']} bets)")
+        if settlement["completed"]:
+            await notify_wager_completed(app, settlement["completed"])
+        if settlement["bets"]:
+            try:
+                await app.bot.send_message(chat_id=chat_id, text=f"✅ Đã trả thưởng phiên {r['round_index']}.")
+            except Exception:
+                pass
 
 async def run_round_for_group(app, chat_id, round_epoch):
     """
     Xử lý 1 vòng chơi cho group chat_id.
-    round_epoch được rounds_loop tính sẵn -> dùng để tạo round_id nhất quán.
+    round_epoch = phiên vừa kết thúc (rounds_loop truyền epoch - 1 tại mốc) -> round_id của các cược.
     """
     try:
         round_index = int(round_epoch)
         round_id = f"{chat_id}_{round_epoch}"
-
-        # lấy cược cho chính round này (chỉ round_id hiện tại)
-        bets_rows = db_query("SELECT user_id, side, amount FROM bets WHERE chat_id=? AND round_id=?", (chat_id, round_id))
-        bets = [dict(r) for r in bets_rows] if bets_rows else []
+        set_log_context(chat_id=chat_id, round_id=round_id)
 
         # lấy chế độ nhóm (force/bettai...)
         grows = db_query("SELECT bet_mode FROM groups WHERE chat_id=?", (chat_id,))
@@ -1282,101 +2497,34 @@ async def run_round_for_group(app, chat_id, round_epoch):
         # compute final result
         result = result_from_total(total)
 
-        # persist history
+        # persist history: settled=0 until settle_round commits, so a failed settlement is retried
+        # by settle_pending_rounds with this exact result instead of being lost
         dice_str = ",".join(map(str, dice))
         try:
             db_execute(
-                "INSERT INTO history(chat_id, round_index, round_id, result, dice, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                "INSERT INTO history(chat_id, round_index, round_id, result, dice, timestamp, volume, settled) VALUES (?, ?, ?, ?, ?, ?, 0, 0)",
                 (chat_id, round_index, round_id, result, dice_str, now_iso())
             )
         except Exception:
-            logger.exception("Failed to insert history")
-
-# ------- Tính winners/losers -------
-        try:
-            # làm gì đó có thể lỗi
-            something()
-        except Exception:
-            logger.exception("Lỗi trong đoạn trước khi tính winners")
-
-# ------- Tính winners/losers -------
-        try:
-            winners = []
-            losers = []
-            total_winner_bets = 0.0
-            total_loser_bets = 0.0
-
-            for b in bets:
-                amt_f = float(b.get("amount") or 0.0)
-                if b.get("side") == result:
-                    winners.append((int(b["user_id"]), amt_f))
-                    total_winner_bets += amt_f
-                else:
-                    losers.append((int(b["user_id"]), amt_f))
-                    total_loser_bets += amt_f
-
-            # Losers -> pot
-            if total_loser_bets > 0:
-                try:
-                    db_execute("UPDATE pot SET amount = amount + ? WHERE id = 1", (total_loser_bets,))
-                except Exception:
-                    logger.exception("Failed to add losers to pot")
-
-            # -------- TRẢ THƯỞNG --------
-            winners_paid = []
-            for uid, amt in winners:
-                try:
-                    house_share = amt * HOUSE_RATE
-                    payout = amt * WIN_MULTIPLIER
-
-                    # cộng house share vào pot
-                    if house_share > 0:
-                        try:
-                            db_execute("UPDATE pot SET amount = amount + ? WHERE id = 1", (house_share,))
-                        except Exception:
-                            logger.exception("Failed to add house share to pot")
-
-                    # đảm bảo user tồn tại
-                    ensure_user(uid, "", "")
-
-                    # cộng tiền thưởng
-                    try:
-                        db_execute(
-                            """
-                            UPDATE users SET
-                                balance = COALESCE(balance, 0) + ?,
-                                current_streak = COALESCE(current_streak, 0) + 1,
-                                best_streak = CASE
-                                    WHEN COALESCE(current_streak, 0) + 1 > COALESCE(best_streak, 0)
-                                    THEN COALESCE(current_streak, 0) + 1
-                                    ELSE COALESCE(best_streak, 0)
-                                END
-                            WHERE user_id = ?
-                            """,
-                            (payout, uid)
-                        )
-                    except Exception:
-                        u = get_user(uid) or {"balance": 0, "current_streak": 0, "best_streak": 0}
-                        new_balance = (u.get("balance") or 0) + payout
-                        new_cur = (u.get("current_streak") or 0) + 1
-                        new_best = max(u.get("best_streak") or 0, new_cur)
-                        db_execute(
-                            "UPDATE users SET balance=?, current_streak=?, best_streak=? WHERE user_id=?",
-                            (new_balance, new_cur, new_best, uid)
-                        )
-
-                    winners_paid.append((uid, payout, amt))
-                except Exception:
-                    logger.exception(f"Error paying winner {uid}")
-
-        except Exception:
-            logger.exception("❌ Lỗi trong block tính winners/losers và trả thưởng")
+            # no recorded result -> nothing may be paid; the bets stay in `bets` untouched
+            logger.exception("Failed to insert history; round left unsettled")
+            report_exception(f"history insert group {chat_id}")
+            await unlock_group_chat(app.bot, chat_id)
+            return
 
-        # Xóa bets chỉ của round này (không xóa tất cả)
+        settlement = None
         try:
-            db_execute("DELETE FROM bets WHERE chat_id=? AND round_id=?", (chat_id, round_id))
+            settlement = settle_round(chat_id, round_id, round_index, result, special)
         except Exception:
-            logger.exception("Failed to delete bets for round")
+            logger.exception("❌ Settlement failed; bets kept for retry")
+            report_exception(f"settlement group {chat_id}")
+        special_msg = settlement["special_msg"] if settlement else ""
+        winners_paid = settlement["winners_paid"] if settlement else []
+        if settlement and settlement["completed"]:
+            try:
+                await notify_wager_completed(app, settlement["completed"])
+            except Exception:
+                logger.exception("Failed to notify wager completion")
 
         # Chuẩn bị và gửi tin nhắn kết quả
         display = "Tài" if result == "tai" else "Xỉu"
@@ -1386,6 +2534,8 @@ async def run_round_for_group(app, chat_id, round_epoch):
         msg += f"Xúc xắc: {' '.join([DICE_CHARS[d-1] for d in dice])} — Tổng: {total}\n"
         if special_msg:
             msg += f"\n{special_msg}\n"
+        if settlement is None and db_query("SELECT 1 FROM bets WHERE chat_id=? AND round_id=? LIMIT 1", (chat_id, round_id)):
+            msg += "\n⏳ Đang xử lý trả thưởng phiên này, tiền sẽ được cộng sau.\n"
         if history_line:
             msg += f"\nLịch sử ({MAX_HISTORY} gần nhất):\n{history_line}\n"
 
@@ -1411,14 +2561,79 @@ async def run_round_for_group(app, chat_id, round_epoch):
         except Exception:
             pass
 
-    except Exception as e:
+    except Exception:
         logger.exception("Exception in run_round_for_group")
-        for aid in ADMIN_IDS:
+        report_exception(f"run_round_for_group group {chat_id}")
+
+# rounds orchestrator: waits for epoch boundaries and coordinates countdowns
+async def rounds_loop(app: Application):
+    logger.info("Rounds orchestrator started")
+    await asyncio.sleep(2)
+    while True:
+        try:
+            now_ts = int(datetime.utcnow().timestamp())
+            next_epoch_ts = ((now_ts // ROUND_SECONDS) + 1) * ROUND_SECONDS
+            rem = next_epoch_ts - now_ts
+
+            if rem > 30:
+                await asyncio.sleep(rem - 30)
+                rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
+                for r in rows:
+                    asyncio.create_task(send_countdown(app.bot, r["chat_id"], 30))
+                await asyncio.sleep(20)
+                rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
+                for r in rows:
+                    asyncio.create_task(send_countdown(app.bot, r["chat_id"], 10))
+                await asyncio.sleep(5)
+                rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
+                for r in rows:
+                    asyncio.create_task(send_countdown(app.bot, r["chat_id"], 5))
+                await asyncio.sleep(5)
+            else:
+                # if less than 30s remain, send appropriate countdowns
+                if rem > 10:
+                    await asyncio.sleep(rem - 10)
+                    rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
+                    for r in rows:
+                        asyncio.create_task(send_countdown(app.bot, r["chat_id"], 10))
+                    await asyncio.sleep(5)
+                    rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
+                    for r in rows:
+                        asyncio.create_task(send_countdown(app.bot, r["chat_id"], 5))
+                    await asyncio.sleep(5)
+                elif rem > 5:
+                    await asyncio.sleep(rem - 5)
+                    rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
+                    for r in rows:
+                        asyncio.create_task(send_countdown(app.bot, r["chat_id"], 5))
+                    await asyncio.sleep(5)
+                else:
+                    # rem <=5
+                    rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
+                    for r in rows:
+                        asyncio.create_task(send_countdown(app.bot, r["chat_id"], 5))
+                    await asyncio.sleep(rem)
+
+            # run rounds at boundary: the round that just ended is the one the bets were placed on
+            ended_epoch = int(datetime.utcnow().timestamp()) // ROUND_SECONDS - 1
             try:
-                await app.bot.send_message(chat_id=aid, text=f"ERROR - run_round_for_group exception for group {chat_id}: {e}\n{traceback.format_exc()}")
+                await settle_pending_rounds(app, ended_epoch)
             except Exception:
-                pass
-        
+                logger.exception("settle_pending_rounds failed")
+            rows = db_query("SELECT chat_id FROM groups WHERE approved=1 AND running=1")
+            tasks = []
+            for r in rows:
+                tasks.append(asyncio.create_task(run_round_for_group(app, r["chat_id"], ended_epoch)))
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        except Exception:
+            logger.exception("Exception in rounds_loop")
+            report_exception("rounds_loop")
+
+# -----------------------
+# Startup / Shutdown + Main entrypoint (PTB v20+ chuẩn)
+# -----------------------
 async def on_startup(app: Application):
     """Hàm chạy khi bot khởi động."""
     logger.info("Bot starting up...")
@@ -1434,6 +2649,12 @@ async def on_startup(app: Application):
     # chạy vòng quay tài xỉu nền
     loop = asyncio.get_running_loop()
     loop.create_task(rounds_loop(app))
+    loop.create_task(alert_flush_loop(app))
+    loop.create_task(balance_snapshot_loop())
+    loop.create_task(maintenance_loop())
+    loop.create_task(backup_loop())
+    start_loop_watchdog()
+    start_memory_diagnostics()
 
 
 async def on_shutdown(app: Application):
@@ -1445,14 +2666,767 @@ async def on_shutdown(app: Application):
         except Exception as e:
             logger.warning(f"Không gửi được tin nhắn shutdown cho admin {aid}: {e}")
 
+# -----------------------
+# Admin error alerts (deduplicated, rate-limited)
+# -----------------------
+ALERT_WINDOW = int(os.getenv("ALERT_WINDOW", "60"))  # seconds of repeats rolled into one alert
+ALERT_COOLDOWN = int(os.getenv("ALERT_COOLDOWN", "600"))  # min seconds between alerts for one fingerprint
+ALERT_MAX_PER_ADMIN = int(os.getenv("ALERT_MAX_PER_ADMIN", "10"))  # alerts per admin per hour
+_alerts: Dict[str, Dict[str, Any]] = {}  # fingerprint -> aggregate
+_admin_alert_times: Dict[int, collections.deque] = {}
+
+def exception_fingerprint(exc: BaseException) -> str:
+    """Exception type + innermost frames; the message is left out because it embeds ids/amounts."""
+    frames = traceback.extract_tb(exc.__traceback__)[-3:]
+    key = type(exc).__name__ + "|" + "|".join(f"{os.path.basename(f.filename)}:{f.name}:{f.lineno}" for f in frames)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+def report_exception(where: str, exc: Optional[BaseException] = None):
+    """Queue an exception for the admins (call from an except block). No network I/O here."""
+    exc = exc or sys.exc_info()[1]
+    if exc is None:
+        return
+    fp = exception_fingerprint(exc)
+    now = time.monotonic()
+    alert = _alerts.get(fp)
+    if alert is None:
+        alert = _alerts[fp] = {
+            "where": where,
+            "summary": f"{type(exc).__name__}: {exc}"[:300],
+            "trace": "".join(traceback.format_exception(exc)[-8:])[-1500:],
+            "first": now_iso(),
+            "count": 0,
+            "pending": 0,
+            "window_start": None,
+            "last_sent": None,
+            "last_seen": now,
+        }
+    alert["count"] += 1
+    alert["pending"] += 1
+    alert["last_seen"] = now
+    if alert["window_start"] is None:
+        alert["window_start"] = now
+
+def _admin_alert_allowed(aid: int, now: float) -> bool:
+    sent = _admin_alert_times.setdefault(aid, collections.deque())
+    while sent and now - sent[0] > 3600:
+        sent.popleft()
+    if len(sent) >= ALERT_MAX_PER_ADMIN:
+        return False
+    sent.append(now)
+    return True
+
+async def flush_alerts(app: Application):
+    now = time.monotonic()
+    for fp, alert in list(_alerts.items()):
+        if not alert["pending"]:
+            if now - alert["last_seen"] > 86400:
+                del _alerts[fp]
+            continue
+        if now - alert["window_start"] < ALERT_WINDOW:
+            continue
+        if alert["last_sent"] is not None and now - alert["last_sent"] < ALERT_COOLDOWN:
+            continue
+        text = f"⚠️ ERROR [{fp}] {alert['where']}\n{alert['summary']}\n"
+        text += f"Lặp lại {alert['pending']} lần kể từ lần báo trước (tổng {alert['count']}, lần đầu {alert['first']})\n"
+        text += f"\n{alert['trace']}"
+        alert["pending"] = 0
+        alert["window_start"] = None
+        alert["last_sent"] = now
+        for aid in ADMIN_IDS:
+            if not _admin_alert_allowed(aid, now):
+                logger.warning(f"Alert {fp} not sent to admin {aid}: hourly cap reached")
+                continue
+            try:
+                await app.bot.send_message(chat_id=aid, text=text[:4000])
+            except Exception as e:
+                logger.warning(f"Cannot send alert {fp} to admin {aid}: {e}")
+
+async def alert_flush_loop(app: Application):
+    while True:
+        await asyncio.sleep(5)
+        try:
+            await flush_alerts(app)
+        except Exception:
+            logger.exception("alert_flush_loop failed")
+
+def alert_metrics() -> List[str]:
+    return [
+        "# TYPE tx_alert_fingerprints gauge",
+        f"tx_alert_fingerprints {len(_alerts)}",
+        "# TYPE tx_alert_occurrences_total counter",
+        f"tx_alert_occurrences_total {sum(a['count'] for a in list(_alerts.values()))}",
+    ]
+
+# -----------------------
+# Event-loop lag watchdog
+# -----------------------
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))  # stalls longer than this get their stack captured
+LOOP_LAG_WINDOW = int(os.getenv("LOOP_LAG_WINDOW", "10"))  # recent samples behind recent_loop_lag()
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_lag_histogram = [0] * (len(LAG_BUCKETS) + 1)  # last slot = +Inf
+_lag_stats = {"count": 0, "sum": 0.0, "max": 0.0, "last": 0.0, "stalls": 0}
+_recent_lag: collections.deque = collections.deque(maxlen=max(LOOP_LAG_WINDOW, 1))
+_recent_stalls: collections.deque = collections.deque(maxlen=20)  # (time, seconds, stack)
+_loop_heartbeat = 0.0  # monotonic time the loop last scheduled a lag probe
+_stall_thread: Optional[threading.Thread] = None
+
+def record_loop_lag(lag: float):
+    i = 0
+    while i < len(LAG_BUCKETS) and lag > LAG_BUCKETS[i]:
+        i += 1
+    _lag_histogram[i] += 1
+    _lag_stats["count"] += 1
+    _lag_stats["sum"] += lag
+    _lag_stats["last"] = lag
+    _recent_lag.append(lag)
+    if lag > _lag_stats["max"]:
+        _lag_stats["max"] = lag
+
+def recent_loop_lag() -> float:
+    """Median of the last LOOP_LAG_WINDOW samples: sustained lag, not one slow wake-up.
+    0 until the window has filled."""
+    if len(_recent_lag) < _recent_lag.maxlen:
+        return 0.0
+    return sorted(_recent_lag)[len(_recent_lag) // 2]
+
+async def loop_lag_monitor():
+    """Measure how late each sleep wakes up compared to when it was scheduled."""
+    global _loop_heartbeat
+    while True:
+        _loop_heartbeat = time.monotonic()
+        scheduled = _loop_heartbeat + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        record_loop_lag(max(0.0, time.monotonic() - scheduled))
+
+def _stall_detector(loop_thread_id: int):
+    # The monitor coroutine can only notice a stall after it ends; this thread looks at the
+    # loop thread *while* it is still blocked, so the stack points at the culprit.
+    reported_beat = None
+    while True:
+        time.sleep(LOOP_LAG_THRESHOLD / 2)
+        beat = _loop_heartbeat
+        stalled = time.monotonic() - beat - LOOP_LAG_INTERVAL
+        if not beat or stalled < LOOP_LAG_THRESHOLD or reported_beat == beat:
+            continue
+        reported_beat = beat
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        stack = "".join(traceback.format_stack(frame)[-12:])
+        del frame
+        _lag_stats["stalls"] += 1
+        _recent_stalls.append((now_iso(), stalled, stack))
+        logger.warning(f"Event loop blocked for {stalled * 1000:.0f}ms+, loop thread stack:\n{stack}")
+
+def start_loop_watchdog():
+    global _stall_thread
+    asyncio.get_running_loop().create_task(loop_lag_monitor())
+    if _stall_thread is None:
+        _stall_thread = threading.Thread(target=_stall_detector, args=(threading.get_ident(),), daemon=True, name="loop-stall-detector")
+        _stall_thread.start()
+
+def loop_lag_metrics() -> List[str]:
+    lines = ["# TYPE tx_loop_lag_seconds histogram"]
+    cumulative = 0
+    for le, n in zip(LAG_BUCKETS, _lag_histogram):
+        cumulative += n
+        lines.append(f'tx_loop_lag_seconds_bucket{{le="{le}"}} {cumulative}')
+    lines.append(f'tx_loop_lag_seconds_bucket{{le="+Inf"}} {_lag_stats["count"]}')
+    lines.append(f'tx_loop_lag_seconds_sum {_lag_stats["sum"]:.6f}')
+    lines.append(f'tx_loop_lag_seconds_count {_lag_stats["count"]}')
+    lines.append(f'tx_loop_lag_max_seconds {_lag_stats["max"]:.6f}')
+    lines.append(f'tx_loop_stalls_total {_lag_stats["stalls"]}')
+    return lines
+
+def render_metrics() -> str:
+    """Prometheus text exposition served on the keep-alive port at /metrics."""
+    lines: List[str] = []
+    lines += loop_lag_metrics()
+    lines += memory_metrics()
+    lines += alert_metrics()
+    lines += user_cache_metrics()
+    lines += lock_metrics()
+    lines += admission_metrics()
+    lines += chat_perm_metrics()
+    return "\n".join(lines) + "\n"
+
+async def lag_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Chỉ admin.")
+        return
+    count = _lag_stats["count"]
+    text = f"Event loop lag ({count} mẫu, mỗi {LOOP_LAG_INTERVAL}s)\n"
+    text += f"Hiện tại: {_lag_stats['last'] * 1000:.1f}ms — max: {_lag_stats['max'] * 1000:.1f}ms — "
+    text += f"TB: {(_lag_stats['sum'] / count * 1000) if count else 0:.1f}ms\n"
+    lower = 0.0
+    for i, n in enumerate(_lag_histogram):
+        upper = f"{LAG_BUCKETS[i] * 1000:g}ms" if i < len(LAG_BUCKETS) else "∞"
+        text += f"≤{upper}: {n}\n" if lower == 0.0 else f"{lower * 1000:g}–{upper}: {n}\n"
+        lower = LAG_BUCKETS[i] if i < len(LAG_BUCKETS) else lower
+    text += f"Số lần block > {LOOP_LAG_THRESHOLD * 1000:g}ms: {_lag_stats['stalls']}\n"
+    if _recent_stalls:
+        when, seconds, stack = _recent_stalls[-1]
+        text += f"\nLần block gần nhất ({when}, {seconds * 1000:.0f}ms+):\n{stack[-2500:]}"
+    await update.message.reply_text(text[:4000])
+
+# -----------------------
+# Memory / task-leak diagnostics (/mem)
+# -----------------------
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "0"))  # >0 enables tracemalloc with this traceback depth (opt-in: it taxes every allocation)
+MEM_SNAPSHOT_INTERVAL = int(os.getenv("MEM_SNAPSHOT_INTERVAL", "900"))
+_mem_snapshots: collections.deque = collections.deque(maxlen=2)  # (iso time, tracemalloc snapshot)
+_mem_growth: List[str] = []  # top allocation growth between the last two snapshots
+_main_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def task_counts(loop: Optional[asyncio.AbstractEventLoop] = None) -> collections.Counter:
+    """Live asyncio tasks grouped by coroutine name."""
+    counts: collections.Counter = collections.Counter()
+    for task in asyncio.all_tasks(loop):
+        coro = task.get_coro()
+        counts[getattr(coro, "__qualname__", type(coro).__name__)] += 1
+    return counts
+
+def take_memory_snapshot(top: int = 15) -> List[str]:
+    """Snapshot tracemalloc and diff against the previous one (CPU heavy: run off the loop)."""
+    snap = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    growth = []
+    if _mem_snapshots:
+        stats = snap.compare_to(_mem_snapshots[-1][1], "lineno")
+        growth = [str(st) for st in stats[:top] if st.size_diff > 0]
+    _mem_snapshots.append((now_iso(), snap))
+    _mem_growth[:] = growth
+    return growth
+
+async def memory_snapshot_loop():
+    while True:
+        await asyncio.sleep(MEM_SNAPSHOT_INTERVAL)
+        try:
+            tasks = task_counts()
+            top_tasks = ", ".join(f"{name}={n}" for name, n in tasks.most_common(5))
+            logger.info(f"RSS {current_rss_bytes() / 1048576:.1f}MB, {sum(tasks.values())} tasks ({top_tasks})")
+            if tracemalloc.is_tracing():
+                growth = await asyncio.to_thread(take_memory_snapshot)
+                if growth:
+                    logger.info("tracemalloc top growth:\n" + "\n".join(growth[:5]))
+        except Exception:
+            logger.exception("memory_snapshot_loop failed")
+
+def start_memory_diagnostics():
+    global _main_loop
+    _main_loop = asyncio.get_running_loop()
+    if TRACEMALLOC_FRAMES > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        take_memory_snapshot()  # baseline
+    _main_loop.create_task(memory_snapshot_loop())
+
+def memory_metrics() -> List[str]:
+    lines = ["# TYPE tx_process_rss_bytes gauge", f"tx_process_rss_bytes {current_rss_bytes()}"]
+    if _main_loop is not None:
+        lines.append("# TYPE tx_asyncio_tasks gauge")
+        try:
+            for name, n in sorted(task_counts(_main_loop).items()):
+                lines.append(f'tx_asyncio_tasks{{coro="{name}"}} {n}')
+        except RuntimeError:
+            pass  # task set changed while scraping from the HTTP thread
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"tx_tracemalloc_current_bytes {current}")
+        lines.append(f"tx_tracemalloc_peak_bytes {peak}")
+    return lines
+
+async def mem_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/mem — RSS, task counts; /mem snap — take a tracemalloc snapshot now and show growth."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Chỉ admin.")
+        return
+    if context.args and context.args[0].lower() == "snap":
+        if not tracemalloc.is_tracing():
+            await update.message.reply_text("tracemalloc đang tắt (TRACEMALLOC_FRAMES=0).")
+            return
+        await asyncio.to_thread(take_memory_snapshot)
+    tasks = task_counts()
+    text = f"RSS: {current_rss_bytes() / 1048576:.1f}MB\n"
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        text += f"tracemalloc: {current / 1048576:.1f}MB (peak {peak / 1048576:.1f}MB)\n"
+    text += f"\nAsyncio tasks: {sum(tasks.values())}\n"
+    for name, n in tasks.most_common(15):
+        text += f"- {name}: {n}\n"
+    if _mem_snapshots:
+        text += f"\nTăng trưởng bộ nhớ (snapshot {_mem_snapshots[-1][0]}):\n"
+        text += "\n".join(_mem_growth) if _mem_growth else "(chưa có so sánh)"
+    await update.message.reply_text(text[:4000])
+
+# -----------------------
+# Runtime sampling profiler (/profile <seconds>)
+# -----------------------
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = 300
+_profile_active = False
+
+def frame_stack(frame) -> List[str]:
+    """Root-first list of `func@file:line` labels for a frame (collapsed-stack friendly)."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name}@{os.path.basename(code.co_filename)}:{code.co_firstlineno}")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def sample_thread_stacks(thread_id: int, seconds: float, interval: float) -> collections.Counter:
+    """Sample another thread's stack every `interval`s; returns collapsed stack -> sample count."""
+    samples: collections.Counter = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples[";".join(frame_stack(frame))] += 1
+        del frame
+        time.sleep(interval)
+    return samples
+
+def summarize_profile(samples: collections.Counter, top: int = 15) -> str:
+    total = sum(samples.values())
+    if not total:
+        return "Không có mẫu nào."
+    cumulative: collections.Counter = collections.Counter()
+    for stack, n in samples.items():
+        for label in set(stack.split(";")):
+            cumulative[label] += n
+    lines = [f"Mẫu: {total}", "Top cumulative:"]
+    for label, n in cumulative.most_common(top):
+        lines.append(f"{100.0 * n / total:5.1f}% {label}")
+    return "\n".join(lines)
+
+async def profile_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _profile_active
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Chỉ admin.")
+        return
+    try:
+        seconds = int(context.args[0]) if context.args else 30
+    except ValueError:
+        await update.message.reply_text("Cú pháp: /profile <giây>")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if _profile_active:
+        await update.message.reply_text("Đang có một phiên profile chạy.")
+        return
+    _profile_active = True
+    try:
+        # handlers run on the event loop thread, so this is the thread to sample
+        loop_thread_id = threading.get_ident()
+        await update.message.reply_text(f"⏱ Đang profile event loop trong {seconds}s...")
+        samples = await asyncio.to_thread(sample_thread_stacks, loop_thread_id, seconds, PROFILE_SAMPLE_INTERVAL)
+    finally:
+        _profile_active = False
+    collapsed = "\n".join(f"{stack} {n}" for stack, n in samples.most_common())
+    await update.message.reply_text(summarize_profile(samples)[:4000])
+    await update.message.reply_document(
+        document=io.BytesIO(collapsed.encode()),
+        filename=f"profile_{int(time.time())}.collapsed",
+        caption="Collapsed stacks (flamegraph.pl / speedscope)"
+    )
+
+# -----------------------
+# Update recorder / replay (real traffic shape for load tests)
+# -----------------------
+_RECORD_ID_KEYS = ("id", "user_id", "chat_id")
+_RECORD_NAME_KEYS = ("username", "first_name", "last_name", "title")
+_RECORD_TEXT_KEYS = ("text", "data", "caption")
+_LONG_NUMBER_RE = re.compile(r"\d{6,}")  # user/chat ids, bank account and phone numbers
+_record_queue: "queue.SimpleQueue[str]" = queue.SimpleQueue()
+_record_thread: Optional[threading.Thread] = None
+
+def pseudonymise_id(value: int) -> int:
+    """Stable pseudonym for a Telegram id. Admin ids are kept so admin commands still replay."""
+    if value in ADMIN_IDS:
+        return value
+    digest = hmac.new(RECORD_SALT.encode(), str(abs(value)).encode(), hashlib.sha256).digest()
+    pseudo = 1_000_000_000 + int.from_bytes(digest[:8], "big") % 9_000_000_000
+    return -pseudo if value < 0 else pseudo
+
+def _pseudonymise_name(value: str) -> str:
+    digest = hmac.new(RECORD_SALT.encode(), value.encode(), hashlib.sha256).hexdigest()
+    return f"u{digest[:10]}"
+
+def _scrub_number(m: "re.Match") -> str:
+    digits = m.group()
+    if len(digits) >= 9:
+        # ids inside text/callback data map to the same pseudonyms as the id fields
+        return str(pseudonymise_id(int(digits)))
+    # shorter runs (accounts, phones, big bet amounts): keyed digits of the same length,
+    # so "/T1000000" still replays as a bet of the same magnitude
+    digest = hmac.new(RECORD_SALT.encode(), digits.encode(), hashlib.sha256).digest()
+    scrubbed = str(int.from_bytes(digest[:8], "big") % (9 * 10 ** (len(digits) - 1)) + 10 ** (len(digits) - 1))
+    return scrubbed
+
+def _anonymise(obj):
+    if isinstance(obj, list):
+        return [_anonymise(v) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for k, v in obj.items():
+        if k in _RECORD_ID_KEYS and isinstance(v, int) and not isinstance(v, bool):
+            out[k] = pseudonymise_id(v)
+        elif k in _RECORD_NAME_KEYS and isinstance(v, str):
+            out[k] = _pseudonymise_name(v)
+        elif k in _RECORD_TEXT_KEYS and isinstance(v, str):
+            out[k] = _LONG_NUMBER_RE.sub(_scrub_number, v)
+        else:
+            out[k] = _anonymise(v)
+    return out
+
+def _open_record_file(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def _record_writer(path: str):
+    with _open_record_file(path, "at") as f:
+        while True:
+            f.write(_record_queue.get())
+            # drain whatever piled up meanwhile, then flush once
+            while True:
+                try:
+                    f.write(_record_queue.get_nowait())
+                except queue.Empty:
+                    break
+            f.flush()
+
+def start_update_recorder(path: str):
+    global _record_thread
+    if _record_thread is not None:
+        return
+    if not RECORD_SALT:
+        # an unkeyed HMAC of a Telegram id is reversible by brute force over the id space
+        raise ValueError("RECORD_SALT must be set to record updates")
+    _record_thread = threading.Thread(target=_record_writer, args=(path,), daemon=True, name="update-recorder")
+    _record_thread.start()
+    logger.info(f"Recording anonymised updates to {path}")
+
+async def log_context_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handler group -2: tag every log line of this update with its chat and user."""
+    chat = update.effective_chat
+    user = update.effective_user
+    set_log_context(chat_id=chat.id if chat else None, user_id=user.id if user else None)
+
+async def record_update_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs in handler group -1 before everything else; never blocks on file I/O."""
+    if _record_thread is None:
+        return
+    try:
+        rec = {"ts": round(time.time(), 3), "update": _anonymise(update.to_dict())}
+        _record_queue.put(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n")
+    except Exception:
+        logger.exception("record_update_handler failed")
+
+def iter_recorded_updates(path: str):
+    """Yield (timestamp, update_dict) from a recording, skipping a torn last line."""
+    with _open_record_file(path, "rt") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            yield rec["ts"], rec["update"]
+
+class ReplayRequest(BaseRequest):
+    """Offline Bot API transport for replays: every call succeeds without touching Telegram."""
+
+    def __init__(self):
+        self._message_id = 0
+        self.calls: Dict[str, int] = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+        elif endpoint.startswith("send") or endpoint.startswith("edit"):
+            self._message_id += 1
+            try:
+                chat_id = int(params.get("chat_id") or 0)
+            except (TypeError, ValueError):
+                chat_id = 0
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def _prepare_replay_state(update: Update, seen_users: set, seen_groups: set, seed_balance: float):
+    # pseudonymised users/groups do not exist in the scratch DB: give them money and approve groups
+    user = update.effective_user
+    if user and user.id not in seen_users:
+        seen_users.add(user.id)
+        ensure_user(user.id, user.username or "", user.first_name or "")
+        if seed_balance > 0:
+            set_balance(user.id, seed_balance)
+    chat = update.effective_chat
+    if chat and chat.type in ("group", "supergroup") and chat.id not in seen_groups:
+        seen_groups.add(chat.id)
+        db_execute(
+            "INSERT OR REPLACE INTO groups(chat_id, title, approved, running, bet_mode, last_round) VALUES (?, ?, 1, 1, 'random', 0)",
+            (chat.id, chat.title or "")
+        )
+
+async def replay_updates(path: str, speed: float = 1.0, seed_balance: float = 0.0, with_rounds: bool = True):
+    """Feed a recording through the real handlers at `speed`x, preserving inter-arrival gaps."""
+    request = ReplayRequest()
+    app = (
+        ApplicationBuilder().token("0:replay").request(request).get_updates_request(ReplayRequest())
+        .concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 1 else False).build()
+    )
+    register_handlers(app)
+    init_db()
+    await app.initialize()
+    await app.start()
+    rounds_task = asyncio.create_task(rounds_loop(app)) if with_rounds else None
+
+    seen_users: set = set()
+    seen_groups: set = set()
+    replayed = 0
+    first_ts = None
+    started = time.monotonic()
+    try:
+        for ts, data in iter_recorded_updates(path):
+            if first_ts is None:
+                first_ts = ts
+            delay = (ts - first_ts) / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            update = Update.de_json(data, app.bot)
+            if update is None:
+                continue
+            _prepare_replay_state(update, seen_users, seen_groups, seed_balance)
+            await app.update_queue.put(update)
+            replayed += 1
+        await app.update_queue.join()
+    finally:
+        if rounds_task:
+            rounds_task.cancel()
+        await app.stop()
+        await app.shutdown()
+    logger.info(f"Replay finished: {replayed} updates in {time.monotonic() - started:.1f}s")
+    return replayed, request.calls
+
+def replay_main(argv: List[str]):
+    global DB_FILE
+    parser = argparse.ArgumentParser(prog="bot.py replay", description="Replay recorded updates against a scratch DB.")
+    parser.add_argument("file", help="recording written via RECORD_UPDATES_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression (10 = ten times faster)")
+    parser.add_argument("--db", default="replay_scratch.db", help="scratch SQLite file (never the live DB)")
+    parser.add_argument("--seed-balance", type=float, default=10_000_000, help="balance given to each replayed user")
+    parser.add_argument("--no-rounds", action="store_true", help="do not run the rounds orchestrator")
+    args = parser.parse_args(argv)
+    if os.path.abspath(args.db) == os.path.abspath(DB_FILE):
+        logger.error("replay: --db must point to a scratch database, not the live DB_FILE")
+        sys.exit(2)
+    DB_FILE = args.db
+    replayed, calls = asyncio.run(replay_updates(args.file, max(args.speed, 0.001), args.seed_balance, not args.no_rounds))
+    print(f"Replayed {replayed} updates. Bot API calls: {json.dumps(calls, sort_keys=True)}")
+
+# -----------------------
+# Offline Monte Carlo simulator: `python bot.py simulate`
+# -----------------------
+# Vectorised over independent groups: each step settles one round in every simulated group at
+# once, with the same rules as run_round_for_group (stake debited at bet time, winners paid
+# amt * WIN_MULTIPLIER, losing stakes + HOUSE_RATE of winning stakes into the group's pot,
+# triple 1 / triple 6 splits the pot pro rata among that round's winners).
+SIM_RESULT_CODES = {"xiu": 0, "tai": 1, "invalid": 2}
+SIM_RESULT_LUT = np.array([SIM_RESULT_CODES[result_from_total(t)] if t >= 3 else 2 for t in range(19)], dtype=np.int8)
+SIM_DICE_BATCH = 256  # rounds of dice generated per RNG call
+
+def simulate_rounds(seed, groups: int, steps: int, players: int, participation: float, stake: float,
+                    win_multiplier: float, house_rate: float, start_balance: float, triple_rule: str) -> Dict[str, Any]:
+    """Run `steps` rounds in each of `groups` independent groups of `players` bettors.
+    triple_rule: "engine" pays the pot to the round's winners (a triple is never tai/xiu, so in the
+    current engine it has none and the pot is kept); "bettors" pays it to everyone who bet."""
+    rng = np.random.default_rng(seed)
+    balance = np.full((groups, players), float(start_balance))
+    pot = np.zeros(groups)
+    pot_peak = np.zeros(groups)
+    staked = paid = pot_paid = 0.0
+    bets = specials = pot_splits = 0
+    done = 0
+    while done < steps:
+        n = min(SIM_DICE_BATCH, steps - done)
+        dice = rng.integers(1, 7, size=(n, groups, 3), dtype=np.int8)
+        totals = dice.sum(axis=2, dtype=np.int8)
+        results = SIM_RESULT_LUT[totals]
+        special = (dice[:, :, 0] == dice[:, :, 1]) & (dice[:, :, 1] == dice[:, :, 2]) & ((dice[:, :, 0] == 1) | (dice[:, :, 0] == 6))
+        for k in range(n):
+            amount = np.minimum(stake, balance)
+            bet = (rng.random((groups, players)) < participation) & (amount >= MIN_BET)
+            amount = np.where(bet, amount, 0.0)
+            side = rng.integers(0, 2, size=(groups, players), dtype=np.int8)
+            win = bet & (side == results[k][:, None])
+            win_amt = np.where(win, amount, 0.0)
+            payout = win_amt * win_multiplier
+            balance += payout - amount
+            pot += (amount.sum(axis=1) - win_amt.sum(axis=1)) + win_amt.sum(axis=1) * house_rate
+
+            sp = special[k]
+            if sp.any():
+                specials += int(sp.sum())
+                share_base = win_amt if triple_rule == "engine" else amount
+                base_total = share_base.sum(axis=1)
+                split = sp & (base_total > 0) & (pot > 0)
+                if split.any():
+                    shares = share_base[split] / base_total[split][:, None] * pot[split][:, None]
+                    balance[split] += shares
+                    pot_paid += float(pot[split].sum())
+                    pot_splits += int(split.sum())
+                    pot[split] = 0.0
+            np.maximum(pot_peak, pot, out=pot_peak)
+            staked += float(amount.sum())
+            paid += float(payout.sum())
+            bets += int(bet.sum())
+        done += n
+    return {
+        "rounds": groups * steps, "bets": bets, "staked": staked, "paid": paid, "pot_paid": pot_paid,
+        "specials": specials, "pot_splits": pot_splits,
+        "pot": pot, "pot_peak": pot_peak, "balance": balance.ravel(),
+    }
+
+def merge_simulations(parts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    merged = {}
+    for key in parts[0]:
+        values = [p[key] for p in parts]
+        merged[key] = np.concatenate(values) if isinstance(values[0], np.ndarray) else sum(values)
+    return merged
+
+def format_simulation(r: Dict[str, Any], start_balance: float) -> str:
+    pct = (1, 10, 50, 90, 99)
+    def dist(a):
+        return "  ".join(f"p{p}={v:,.0f}" for p, v in zip(pct, np.percentile(a, pct)))
+    house_cash = r["staked"] - r["paid"] - r["pot_paid"]
+    outstanding = float(r["pot"].sum())
+    lines = [
+        f"rounds={r['rounds']:,}  bets={r['bets']:,}  staked={r['staked']:,.0f}",
+        f"house cash P&L={house_cash:,.0f} ({house_cash / max(r['staked'], 1):.3%} of stake), "
+        f"after pot liability={house_cash - outstanding:,.0f} ({(house_cash - outstanding) / max(r['staked'], 1):.3%})",
+        f"triple1/6 rounds={r['specials']:,}  pot splits={r['pot_splits']:,}  pot paid={r['pot_paid']:,.0f}",
+        f"final pot per group:  {dist(r['pot'])}",
+        f"peak pot per group:   {dist(r['pot_peak'])}",
+        f"player balances:      {dist(r['balance'])}",
+        f"players below MIN_BET: {(r['balance'] < MIN_BET).mean():.1%}   above start: {(r['balance'] > start_balance).mean():.1%}",
+    ]
+    return "\n".join(lines)
+
+def simulate_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="bot.py simulate", description="Monte Carlo of the settlement rules (pot, balances, house edge).")
+    parser.add_argument("--rounds", type=int, default=1_000_000, help="total rounds across all groups")
+    parser.add_argument("--groups", type=int, default=1000, help="independent groups simulated side by side")
+    parser.add_argument("--players", type=int, default=20, help="bettors per group")
+    parser.add_argument("--participation", type=float, default=0.5, help="chance a player bets in a round")
+    parser.add_argument("--stake", type=float, default=MIN_BET * 10, help="bet size (capped at balance)")
+    parser.add_argument("--start-balance", type=float, default=START_BONUS, help="initial balance (default START_BONUS)")
+    parser.add_argument("--win-multiplier", type=float, default=WIN_MULTIPLIER)
+    parser.add_argument("--house-rate", type=float, default=HOUSE_RATE)
+    parser.add_argument("--triple-rule", choices=("engine", "bettors"), default="engine",
+                        help="who shares the pot on triple 1/6: the round's winners (engine) or all its bettors")
+    parser.add_argument("--workers", type=int, default=1, help="processes; groups are split between them")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    workers = max(1, min(args.workers, args.groups))
+    steps = -(-args.rounds // args.groups)
+    seeds = np.random.SeedSequence(args.seed).spawn(workers)
+    split = [args.groups // workers + (i < args.groups % workers) for i in range(workers)]
+    jobs = [(seeds[i], split[i], steps, args.players, args.participation, args.stake, args.win_multiplier,
+             args.house_rate, args.start_balance, args.triple_rule) for i in range(workers)]
+    started = time.monotonic()
+    if workers == 1:
+        parts = [simulate_rounds(*jobs[0])]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(simulate_rounds, *zip(*jobs)))
+    result = merge_simulations(parts)
+    print(f"WIN_MULTIPLIER={args.win_multiplier} HOUSE_RATE={args.house_rate} start={args.start_balance:,.0f} "
+          f"stake={args.stake:,.0f} triple_rule={args.triple_rule}")
+    print(format_simulation(result, args.start_balance))
+    print(f"({time.monotonic() - started:.1f}s, {workers} worker(s))")
+
+def dice_chi_square(values) -> Tuple[float, List[int]]:
+    counts = np.bincount(np.asarray(values, dtype=np.int64), minlength=7)[1:]
+    expected = counts.sum() / 6
+    return float(((counts - expected) ** 2 / expected).sum()), counts.tolist()
+
+def dicetest_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="bot.py dicetest", description="Chi-square uniformity self-test + throughput of the dice source.")
+    parser.add_argument("--samples", type=int, default=1_200_000)
+    parser.add_argument("--repeat", type=int, default=5, help="independent chi-square runs")
+    args = parser.parse_args(argv)
+    # chi-square, 5 degrees of freedom: P(X > 20.515) = 0.001
+    critical = 20.515
+    src = DiceSource()
+    failures = 0
+    for i in range(args.repeat):
+        chi2, counts = dice_chi_square(src.rolls(args.samples))
+        failures += chi2 > critical
+        print(f"run {i + 1}: chi2={chi2:.2f} ({'ok' if chi2 <= critical else 'FAIL'} at p=0.001) counts={counts}")
+
+    n = 200_000
+    started = time.perf_counter()
+    for _ in range(n):
+        src.roll()
+    per_roll = (time.perf_counter() - started) / n
+    started = time.perf_counter()
+    src.rolls(n)
+    batch = (time.perf_counter() - started) / n
+    started = time.perf_counter()
+    for _ in range(n):
+        random.randint(1, 6)
+    mt = (time.perf_counter() - started) / n
+    print(f"roll(): {1 / per_roll:,.0f}/s  rolls(): {1 / batch:,.0f}/s  random.randint (reference): {1 / mt:,.0f}/s")
+    print(f"urandom refills: {src.refills} x {src.block} bytes")
+    if failures > 1:
+        sys.exit(1)
+
 # ==============================
 # Handler rút tiền (dán trước hàm main)
 # ==============================
 from telegram import Update
 from telegram.ext import ContextTypes
 
+async def ruttien_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        f"Rút tiền: /ruttien <Ngân hàng> <Số TK> <Số tiền>\n"
+        f"Tối thiểu {WITHDRAW_MIN:,}₫, tối đa {WITHDRAW_DAILY_LIMIT:,}₫/ngày. Admin sẽ duyệt yêu cầu."
+    )
+
 async def ruttien_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Xử lý lệnh rút tiền từ người chơi."""
+    """Xử lý lệnh rút tiền từ người chơi: tạo yêu cầu 'pending' và gửi admin duyệt."""
     try:
         args = context.args
         if len(args) < 3:
@@ -1469,15 +3443,39 @@ async def ruttien_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Số tiền không hợp lệ.")
             return
 
-        if amount < 100000:
-            await update.message.reply_text("⚠️ Số tiền rút tối thiểu là 100.000đ.")
+        if amount < WITHDRAW_MIN:
+            await update.message.reply_text(f"⚠️ Số tiền rút tối thiểu là {WITHDRAW_MIN:,}đ.")
             return
 
-        # (giả lập kiểm tra số dư)
-        balance = 9999999  
-        if amount > balance:
+        user = update.effective_user
+        u = get_user(user.id)
+        if not u or (u["balance"] or 0.0) < amount:
             await update.message.reply_text("⚠️ Số dư không đủ.")
             return
+        if u["start_bonus_given"] == 1 and (u["start_bonus_progress"] or 0) < START_BONUS_REQUIRED_ROUNDS:
+            await update.message.reply_text(f"⚠️ Bạn cần cược đủ {START_BONUS_REQUIRED_ROUNDS} vòng (thưởng /start) trước khi rút.")
+            return
+        if db_query("SELECT 1 FROM promo_redemptions WHERE user_id=? AND active=1 LIMIT 1", (user.id,)):
+            await update.message.reply_text("⚠️ Bạn chưa hoàn thành yêu cầu cược của code khuyến mãi.")
+            return
+        if withdrawn_today(user.id) + amount > WITHDRAW_DAILY_LIMIT:
+            await update.message.reply_text(f"⚠️ Vượt giới hạn rút {WITHDRAW_DAILY_LIMIT:,}₫/ngày.")
+            return
+
+        wid = db_execute(
+            "INSERT INTO withdrawals(user_id, amount, bank, account, status, created_at) VALUES (?, ?, ?, ?, 'pending', ?)",
+            (user.id, amount, bank, account, now_iso())
+        )
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Duyệt", callback_data=f"withdraw_ok|{wid}"),
+             InlineKeyboardButton("Từ chối", callback_data=f"withdraw_no|{wid}")]
+        ])
+        text = f"Yêu cầu rút #{wid}\nUser: {user.id} (@{user.username or '-'})\nSố tiền: {amount:,}₫\nNgân hàng: {bank}\nSố TK: {account}"
+        for aid in ADMIN_IDS:
+            try:
+                await context.bot.send_message(chat_id=aid, text=text, reply_markup=kb)
+            except Exception:
+                logger.exception("Cannot notify admin for withdrawal")
 
         await update.message.reply_text(
             f"✅ Đã nhận yêu cầu rút {amount:,}đ về {bank} ({account}).\nĐang xử lý..."
@@ -1485,51 +3483,285 @@ async def ruttien_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     except Exception as e:
         await update.message.reply_text("❌ Lỗi hệ thống khi xử lý yêu cầu rút tiền.")
-        print("ruttien_handler error:", e)
+        logger.exception(f"ruttien_handler error: {e}")
+
+# -----------------------
+# Concurrent updates: keyed locks serialise per user / per chat
+# -----------------------
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))  # <= 1 = PTB's sequential processing
+UPDATE_LOCK_TIMEOUT = float(os.getenv("UPDATE_LOCK_TIMEOUT", "10"))
+
+class LockTimeout(Exception):
+    pass
+
+class KeyedLockManager:
+    """One asyncio.Lock per key, created on demand and dropped when nobody holds or waits for it.
+    Multiple keys are taken in sorted order, so (user, chat) holders cannot deadlock."""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+        self._refs: Dict[Tuple[str, int], int] = {}
+        self.stats = {"acquired": 0, "contended": 0, "timeouts": 0, "wait_seconds": 0.0, "max_wait": 0.0}
+
+    async def _acquire(self, key: Tuple[str, int]):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._refs[key] = self._refs.get(key, 0) + 1
+        started = time.monotonic()
+        acquired = contended = False
+
+        async def take():
+            nonlocal acquired, contended
+            contended = lock.locked()
+            if contended:
+                self.stats["contended"] += 1
+            acquired = await lock.acquire()
+
+        try:
+            await asyncio.wait_for(take(), self.timeout)
+        except BaseException as e:
+            # wait_for can time out / be cancelled in the same loop turn the lock is granted:
+            # if we own it by now, hand it back so the key is never wedged
+            if acquired:
+                lock.release()
+            self._unref(key)
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["timeouts"] += 1
+                raise LockTimeout(key) from None
+            raise
+        self.stats["acquired"] += 1
+        if contended:
+            waited = time.monotonic() - started
+            self.stats["wait_seconds"] += waited
+            self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+
+    def _unref(self, key: Tuple[str, int]):
+        self._refs[key] -= 1
+        if not self._refs[key]:
+            del self._refs[key]
+            del self._locks[key]
+
+    @asynccontextmanager
+    async def hold(self, *keys: Tuple[str, int]):
+        held = []
+        try:
+            for key in sorted(set(keys)):
+                await self._acquire(key)
+                held.append(key)
+            yield
+        finally:
+            for key in reversed(held):
+                self._locks[key].release()
+                self._unref(key)
+
+update_locks = KeyedLockManager(UPDATE_LOCK_TIMEOUT)
+
+def user_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> List[Tuple[str, int]]:
+    return [("user", update.effective_user.id)] if update.effective_user else []
+
+def chat_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> List[Tuple[str, int]]:
+    return [("chat", update.effective_chat.id)] if update.effective_chat else []
+
+def addmoney_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> List[Tuple[str, int]]:
+    # the balance being changed is the target's, not the admin's
+    try:
+        return [("user", int(context.args[0]))]
+    except (IndexError, ValueError, TypeError):
+        return []
+
+def withdrawal_owner_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> List[Tuple[str, int]]:
+    try:
+        wid = int((update.callback_query.data or "").split("|")[1])
+    except (IndexError, ValueError):
+        return []
+    rows = db_query("SELECT user_id FROM withdrawals WHERE id=?", (wid,))
+    return [("user", rows[0]["user_id"])] if rows else []
+
+def approve_chat_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> List[Tuple[str, int]]:
+    try:
+        return [("chat", int((update.callback_query.data or "").split("|")[1]))]
+    except (IndexError, ValueError):
+        return []
+
+def serialized(handler, keys=user_key):
+    """Wrap a handler so updates sharing a key (user / chat) run one at a time, others in parallel."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            async with update_locks.hold(*keys(update, context)):
+                return await handler(update, context)
+        except LockTimeout as e:
+            logger.warning(f"{handler.__name__}: lock {e.args[0]} not acquired in {UPDATE_LOCK_TIMEOUT}s")
+            busy = "⏳ Yêu cầu trước của bạn đang được xử lý, vui lòng thử lại."
+            if update.callback_query:
+                await update.callback_query.answer(busy, show_alert=True)
+            elif update.effective_message:
+                await update.effective_message.reply_text(busy)
+    return wrapper
+
+def lock_metrics() -> List[str]:
+    s = update_locks.stats
+    return [
+        "# TYPE tx_update_lock_acquired_total counter", f"tx_update_lock_acquired_total {s['acquired']}",
+        "# TYPE tx_update_lock_contended_total counter", f"tx_update_lock_contended_total {s['contended']}",
+        "# TYPE tx_update_lock_timeouts_total counter", f"tx_update_lock_timeouts_total {s['timeouts']}",
+        "# TYPE tx_update_lock_wait_seconds_total counter", f"tx_update_lock_wait_seconds_total {s['wait_seconds']:.6f}",
+        "# TYPE tx_update_lock_wait_max_seconds gauge", f"tx_update_lock_wait_max_seconds {s['max_wait']:.6f}",
+        "# TYPE tx_update_locks_active gauge", f"tx_update_locks_active {len(update_locks._locks)}",
+    ]
+
+# -----------------------
+# Bet admission control: token buckets per user / chat + global load shedding
+# -----------------------
+BET_RATE_PER_USER = float(os.getenv("BET_RATE_PER_USER", "1"))  # bets/s refill
+BET_BURST_PER_USER = int(os.getenv("BET_BURST_PER_USER", "5"))
+BET_RATE_PER_CHAT = float(os.getenv("BET_RATE_PER_CHAT", "20"))
+BET_BURST_PER_CHAT = int(os.getenv("BET_BURST_PER_CHAT", "100"))
+SHED_LOOP_LAG = float(os.getenv("SHED_LOOP_LAG", "0.5"))  # median recent event-loop lag (s) that triggers shedding
+SHED_INFLIGHT = int(os.getenv("SHED_INFLIGHT", "200"))  # bet updates being handled / waiting on locks
+BET_BUCKETS_MAX = int(os.getenv("BET_BUCKETS_MAX", "50000"))  # idle buckets are pruned past this many keys
+_bet_buckets: Dict[Tuple[str, int], List[float]] = {}  # key -> [tokens, last, warned, seconds to refill]
+_bet_buckets_prune_at = BET_BUCKETS_MAX
+_shed_notices: Dict[int, float] = {}  # chat_id -> last "overloaded" notice
+_admission_stats = {"admitted": 0, "user_limited": 0, "chat_limited": 0, "shed": 0, "inflight": 0}
+
+def take_bet_token(key: Tuple[str, int], rate: float, burst: int, now: float) -> Optional[List[float]]:
+    """Token bucket like LogContextFilter's: None if a token was taken, else the empty bucket."""
+    global _bet_buckets_prune_at
+    bucket = _bet_buckets.get(key)
+    if bucket is None:
+        if len(_bet_buckets) >= _bet_buckets_prune_at:
+            # buckets idle long enough to be full again (by their own rate / burst) carry no state;
+            # the next sweep waits until the map doubles, so the scan is amortised O(1) per new key
+            for k in [k for k, b in _bet_buckets.items() if now - b[1] >= b[3]]:
+                del _bet_buckets[k]
+            _bet_buckets_prune_at = max(BET_BUCKETS_MAX, 2 * len(_bet_buckets))
+        bucket = _bet_buckets[key] = [float(burst), now, 0, burst / max(rate, 0.01)]
+    bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] < 1.0:
+        return bucket
+    bucket[0] -= 1.0
+    bucket[2] = 0
+    return None
+
+def overloaded() -> bool:
+    return recent_loop_lag() > SHED_LOOP_LAG or _admission_stats["inflight"] > SHED_INFLIGHT
+
+def bet_admission(handler):
+    """Front door for bet messages: runs before any DB work or lock wait. Excess bets are dropped;
+    the user gets one warning per burst, an overloaded chat one notice per round."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        msg, user, chat = update.effective_message, update.effective_user, update.effective_chat
+        if not msg or not user or not chat:
+            return
+        now = time.monotonic()
+        if overloaded():
+            _admission_stats["shed"] += 1
+            if now - _shed_notices.get(chat.id, 0.0) >= ROUND_SECONDS:
+                _shed_notices[chat.id] = now
+                await msg.reply_text("⏳ Hệ thống đang quá tải, cược tạm thời bị từ chối. Vui lòng thử lại sau ít giây.")
+            return
+        limited = take_bet_token(("user", user.id), BET_RATE_PER_USER, BET_BURST_PER_USER, now)
+        if limited is not None:
+            _admission_stats["user_limited"] += 1
+            if not limited[2]:
+                limited[2] = 1
+                await msg.reply_text("⚠️ Bạn đặt cược quá nhanh, các lệnh thừa sẽ bị bỏ qua.")
+            return
+        if take_bet_token(("chat", chat.id), BET_RATE_PER_CHAT, BET_BURST_PER_CHAT, now) is not None:
+            _admission_stats["chat_limited"] += 1
+            return
+        _admission_stats["admitted"] += 1
+        _admission_stats["inflight"] += 1
+        try:
+            return await handler(update, context)
+        finally:
+            _admission_stats["inflight"] -= 1
+    return wrapper
+
+def admission_metrics() -> List[str]:
+    s = _admission_stats
+    lines = []
+    for key in ("admitted", "user_limited", "chat_limited", "shed"):
+        lines += [f"# TYPE tx_bets_{key}_total counter", f"tx_bets_{key}_total {s[key]}"]
+    lines += ["# TYPE tx_bets_inflight gauge", f"tx_bets_inflight {s['inflight']}",
+              "# TYPE tx_bets_shedding gauge", f"tx_bets_shedding {int(overloaded())}"]
+    return lines
 
 # ==============================
 # Hàm main — để nguyên bên dưới
 # ==============================
-def main():
-    """Main entrypoint — dùng run_polling() thay cho updater.start_polling()"""
-    if not BOT_TOKEN or BOT_TOKEN == "PUT_YOUR_BOT_TOKEN_HERE":
-        print("❌ ERROR: BOT_TOKEN not set. Please set BOT_TOKEN env variable.")
-        return
-
-    # Khởi tạo database
-    init_db()
-
-    # Tạo app
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+def register_handlers(app: Application):
+    """Đăng ký toàn bộ handler (dùng chung cho main() và replay).
+    Updates run concurrently; handlers that move money are wrapped in serialized() (per user / chat)."""
+    app.add_handler(TypeHandler(Update, log_context_handler), group=-2)
 
-    # ----- Đăng ký HANDLERS -----
     # user
-    app.add_handler(CommandHandler("start", start_handler))
+    app.add_handler(CommandHandler("start", serialized(start_handler)))
     app.add_handler(CommandHandler("game", game_info))
     app.add_handler(CommandHandler("nap", nap_info))
-    app.add_handler(CommandHandler("ruttien", ruttien_handler))
-    app.add_handler(CallbackQueryHandler(withdraw_callback_handler, pattern=r"^withdraw_.*|^withdraw.*"))
+    app.add_handler(CommandHandler("lichsu", lichsu_handler))
+    app.add_handler(CommandHandler("ruttien", serialized(ruttien_handler)))
+    app.add_handler(CallbackQueryHandler(serialized(withdraw_callback_handler, withdrawal_owner_key), pattern=r"^withdraw_(ok|no)\|"))
     app.add_handler(CallbackQueryHandler(callback_query_handler, pattern=r"^game_.*"))
+    app.add_handler(CallbackQueryHandler(serialized(allin_callback_handler), pattern=r"^allin\|"))
 
     # admin
-    app.add_handler(CommandHandler("addmoney", addmoney_handler))
+    app.add_handler(CommandHandler("addmoney", serialized(addmoney_handler, addmoney_key)))
     app.add_handler(CommandHandler("top10", top10_handler))
     app.add_handler(CommandHandler("balances", balances_handler))
+    app.add_handler(CommandHandler("users", users_browser_handler))
+    app.add_handler(CommandHandler("ledger", ledger_handler))
+    app.add_handler(CommandHandler("export", export_handler))
+    app.add_handler(CommandHandler("backup", backup_handler))
+    app.add_handler(CommandHandler("thongke", thongke_handler))
+    app.add_handler(CallbackQueryHandler(users_browser_callback, pattern=r"^ub\|"))
     app.add_handler(CommandHandler("KqTai", admin_force_handler))
     app.add_handler(CommandHandler("KqXiu", admin_force_handler))
     app.add_handler(CommandHandler("bettai", admin_force_handler))
     app.add_handler(CommandHandler("betxiu", admin_force_handler))
     app.add_handler(CommandHandler("tatbet", admin_force_handler))
     app.add_handler(CommandHandler("code", admin_create_code_handler))
-    app.add_handler(CommandHandler("nhancode", redeem_code_handler))
+    app.add_handler(CommandHandler("nhancode", serialized(redeem_code_handler)))
+    app.add_handler(CommandHandler("profile", profile_handler, block=False))
+    app.add_handler(CommandHandler("lag", lag_handler))
+    app.add_handler(CommandHandler("mem", mem_handler))
 
     # group control
-    app.add_handler(CommandHandler("batdau", batdau_handler))
-    app.add_handler(CallbackQueryHandler(approve_callback_handler, pattern=r"^(approve|deny)\|"))
+    app.add_handler(CommandHandler("batdau", serialized(batdau_handler, chat_key)))
+    app.add_handler(CallbackQueryHandler(serialized(approve_callback_handler, approve_chat_key), pattern=r"^(approve|deny)\|"))
+    app.add_handler(ChatMemberHandler(my_chat_member_handler, ChatMemberHandler.MY_CHAT_MEMBER))
 
     # bets & private menu
-    app.add_handler(MessageHandler(filters.Regex(r"^/[TtXx]\d+"), bet_message_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, menu_text_handler))
+    app.add_handler(MessageHandler(filters.TEXT & BET_FILTER, bet_admission(serialized(bet_message_handler))))
+    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND, menu_text_handler))
+
+def main():
+    """Main entrypoint — dùng run_polling() thay cho updater.start_polling()"""
+    if not BOT_TOKEN or BOT_TOKEN == "PUT_YOUR_BOT_TOKEN_HERE":
+        logger.error("BOT_TOKEN not set. Please set BOT_TOKEN env variable.")
+        return
+
+    threading.Thread(target=keep_port_open, daemon=True).start()
+
+    # Khởi tạo database
+    init_db()
+
+    # Tạo app
+    app = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 1 else False).build()
+
+    # ----- Đăng ký HANDLERS -----
+    register_handlers(app)
+    if RECORD_UPDATES_FILE:
+        try:
+            start_update_recorder(RECORD_UPDATES_FILE)
+            app.add_handler(TypeHandler(Update, record_update_handler), group=-1)
+        except ValueError as e:
+            logger.error(f"Update recorder disabled: {e}")
 
     # lifecycle hooks
     app.post_init = on_startup
@@ -1559,7 +3791,7 @@ async def game_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "- Tài: tổng 11–17\n"
         "- Xỉu: tổng 4–10\n"
         "- Mỗi phiên 60s\n"
-        "- Đặt cược bằng: /T<tiền> hoặc /X<tiền>\n"
+        "- Đặt cược bằng: /T<tiền>, T<tiền>, X 5k, T1tr hoặc T all (tất tay)\n"
         "👉 Tham gia nhóm chơi: @VET789cc",
         parse_mode="Markdown",
     )
@@ -1572,7 +3804,17 @@ async def nap_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------
 # Run as script
 # -----------------------
+CLI_COMMANDS = {
+    "replay": replay_main,  # python bot.py replay updates.jsonl.gz --speed 10
+    "export": export_main,  # python bot.py export ledger --format jsonl --since 2024-01-01
+    "dicetest": dicetest_main,  # python bot.py dicetest --samples 1200000
+    "simulate": simulate_main,  # python bot.py simulate --rounds 1000000 --win-multiplier 1.95 --workers 4
+}
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        CLI_COMMANDS[sys.argv[1]](sys.argv[2:])
+        sys.exit(0)
     try:
         main()
     except Exception: